@@ -208,6 +208,7 @@ export class DsDriver {
 
   /**
    * Removes a training point from a snippet.
+   * The server moves the last training point into the removed index.
    * @param {string} name Snippet name
    * @param {number} index Integer array index indicating value to remove
    */
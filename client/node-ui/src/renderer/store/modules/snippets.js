@@ -170,15 +170,23 @@ function computeThreshold(t, mode, max, current) {
 function filterByImpact(snippet, threshold) {
   // ok first check that we have the right data
   if (snippet && snippet.trained) {
-    const rawLs =
-      snippet.trainData.state['covar_module.base_kernel.raw_lengthscale'][0];
-
-    // Either we have a manual filter, or the snippet was trained with the default (returned by the
-    // snippet server)
-    const ids =
-      snippet.filter && snippet.filter.length > 0
-        ? snippet.filter
-        : snippet.trainData.defaultFilter;
+    // the lengthscale key depends on the kernel mode (SGPR nests the kernel deeper)
+    const state = snippet.trainData.state;
+    const lsKey = Object.keys(state).find(key =>
+      key.endsWith('base_kernel.raw_lengthscale')
+    );
+    const rawLs = state[lsKey][0];
+
+    // The server returns the filter the model was trained on (relevance pruning can drop params).
+    // Older results don't have it: either we have a manual filter, or the snippet was trained
+    // with the default (returned by the snippet server)
+    let ids = snippet.trainData.filter;
+    if (!ids) {
+      ids =
+        snippet.filter && snippet.filter.length > 0
+          ? snippet.filter
+          : snippet.trainData.defaultFilter;
+    }
 
     // convert to lengthscale (softmax)
     const ls = rawLs.map(x => Math.log(1 + Math.exp(x)));
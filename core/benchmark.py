@@ -21,10 +21,13 @@ results = {}
 # 3 - test set (can be same as training file)
 # 4 - test snippet name
 # 5 - output filename
+# 6 - (optional) snippet kernel mode, default RBF. Prediction errors are always relative
+#     to the exact RBF snippet trained for the most iterations
 allTrainData = None
 allTestData = None
 prefix = ""
 outFilePath = ""
+kernelMode = sys.argv[6] if len(sys.argv) > 6 else "RBF"
 
 if sys.argv[1] != "random":
     # test on "real" dataset
@@ -79,13 +82,18 @@ else:
 for i in iters:
     sn = Snippet("{0}-{1}".format(prefix, i))
     sn.optSteps = i
+    sn.kernelMode = kernelMode
     sn.setData(allTrainData)
     snippets[i] = sn
 
 for key in snippets:
     # benchmark testing
     s = snippets[key]
-    print("Testing Snippet {0} - iters: {1}".format(s.name, s.optSteps))
+    print(
+        "Testing Snippet {0} - iters: {1}, mode: {2}".format(
+            s.name, s.optSteps, s.kernelMode
+        )
+    )
 
     t = time.perf_counter()
     res = s.train()
@@ -97,18 +105,61 @@ for key in snippets:
     print("Snippet {0} training complete".format(s.name))
     print("{0}s, loss: {1}".format(elapsed, s.losses[-1]))
 
+# precision modes: every iteration count is trained again in each mode. Errors are the
+# largest difference from the float64 predictions over the test set
+precisionModes = ["float32", "float64", "mixed"]
+precisionResults = {}
+testX = torch.tensor([pt["x"] for pt in allTestData], dtype=torch.float64)
+
+for key in snippets:
+    precisionResults[key] = {}
+    for mode in precisionModes:
+        sp = snippets[key].clone("{0}-{1}".format(snippets[key].name, mode))
+        sp.precision = mode
+
+        t = time.perf_counter()
+        sp.train()
+        trainTime = time.perf_counter() - t
+
+        t = time.perf_counter()
+        pred = sp.predict(testX)["mean"]
+        predictTime = time.perf_counter() - t
+
+        precisionResults[key][mode] = {
+            "time": trainTime,
+            "predict time": predictTime,
+            "pred": pred.double(),
+        }
+        print("Snippet {0} trained in {1}s".format(sp.name, trainTime))
+
+    for mode in precisionModes:
+        res = precisionResults[key][mode]
+        err = res["pred"] - precisionResults[key]["float64"]["pred"]
+        res["max err"] = err.abs().max().item()
+
 # should export to CSV or something
 # losses
 outCSV = "id,iters,time,pct max,loss,loss delta"
+
+for mode in precisionModes:
+    outCSV = outCSV + ",{0} time,{0} predict time,{0} max err".format(mode)
 maxTime = results[iters[-1]]["time"]
 maxLoss = snippets[iters[-1]].losses[-1]
 
 # add test column headers and data
 testRefVals = []
+refSnippet = snippets[iters[-1]]
+
+if kernelMode != "RBF":
+    refSnippet = Snippet("{0}-exact".format(prefix))
+    refSnippet.optSteps = iters[-1]
+    refSnippet.setData(allTrainData)
+    refSnippet.train()
+    print("Trained exact reference snippet {0}".format(refSnippet.name))
 
 for i in range(0, len(allTestData)):
     pt = allTestData[i]
-    testRefVals.append(snippets[iters[-1]].predictOne(pt["x"])["mean"])
+    testRefVals.append(refSnippet.predictOne(pt["x"])["mean"])
     outCSV = outCSV + ",pred{0},err{0}".format(i)
 
 outCSV = outCSV + "\n"
@@ -126,6 +177,12 @@ for key in snippets:
         s.losses[-1] - maxLoss,
     )
 
+    for mode in precisionModes:
+        pres = precisionResults[key][mode]
+        row = row + ",{0},{1},{2}".format(
+            pres["time"], pres["predict time"], pres["max err"]
+        )
+
     for i in range(0, len(allTestData)):
         pt = allTestData[i]
         pred = s.predictOne(pt["x"])["mean"]
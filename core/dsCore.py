@@ -1,4 +1,4 @@
-from snippet import Snippet
+from snippet import Snippet, trainSnippetBatch
 from dsTypes import DSStatus
 
 
@@ -41,3 +41,37 @@ class SnippetServer:
 
     def deleteAllSnippets(self):
         self.snippets = {}
+
+    # retrains the named snippets (all of them by default). Exact RBF snippets using adam
+    # (and no multi-start) are grouped by filter size, learning rate and precision, and
+    # each group is trained as one batch model. Everything else trains on its own.
+    # Returns retData by snippet name
+    def trainSnippets(self, names=None, warmStart=None):
+        if names is None:
+            names = self.listSnippets()
+
+        results = {}
+        groups = {}
+        for name in names:
+            s = self.getSnippet(name)
+            if s is None:
+                continue
+
+            batchable = (
+                s.kernelMode == "RBF"
+                and s.optimizer == "adam"
+                and s.restarts == 1
+                and not s.restartLearningRates
+            )
+            if s.dataCount == 0 or not batchable:
+                results[name] = s.train(warmStart=warmStart)
+                continue
+
+            key = (len(s.getDefaultFilter()), s.learningRate, s.trainDtype())
+            groups.setdefault(key, []).append(s)
+
+        for key in groups:
+            for s, res in zip(groups[key], trainSnippetBatch(groups[key], warmStart)):
+                results[s.name] = res
+
+        return results
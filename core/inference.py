@@ -0,0 +1,58 @@
+import numpy as np
+
+
+# lightweight predictor exported from a trained RBF snippet (see Snippet.compile).
+# It only holds contiguous arrays: no torch modules, autograd graphs or optimizer state.
+# predict / predictOne follow the same {"mean", "cov"} contract as the snippet, so it
+# can be used anywhere a snippet is only used for scoring.
+class CompiledSnippet:
+    def __init__(
+        self,
+        name,
+        filter,
+        lengthscale,
+        outputscale,
+        noise,
+        constant,
+        jitter,
+        X,
+        alpha,
+        varianceCache,
+        dtype=np.float64,
+    ):
+        self.name = name
+        self.filter = list(filter)
+        self.dtype = dtype
+        self.filterIdx = np.array(self.filter, dtype=np.int64)
+        self.lengthscale = np.ascontiguousarray(lengthscale, dtype=dtype)
+        self.outputscale = float(outputscale)
+        self.noise = float(noise)
+        self.constant = float(constant)
+        self.jitter = float(jitter)
+
+        # training inputs are stored pre-scaled by the lengthscales
+        self.Z = np.ascontiguousarray(X / lengthscale, dtype=dtype)
+        self.ZSq = (self.Z**2).sum(axis=1)
+        self.alpha = np.ascontiguousarray(alpha, dtype=dtype)
+        self.varianceCache = np.ascontiguousarray(varianceCache, dtype=dtype)
+
+    # items are full parameter vectors (list of lists, array or cpu tensor)
+    def predict(self, items):
+        X = np.asarray(items, dtype=self.dtype)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+
+        Z = X[:, self.filterIdx] / self.lengthscale
+        d = (Z**2).sum(axis=1, keepdims=True) - 2 * (Z @ self.Z.T) + self.ZSq
+        Kxs = self.outputscale * np.exp(-0.5 * np.maximum(d, 0))
+
+        mean = self.constant + Kxs @ self.alpha
+        V = Kxs @ self.varianceCache
+        cov = self.outputscale + self.jitter + self.noise - (V**2).sum(axis=1)
+
+        return {"mean": mean, "cov": cov}
+
+    def predictOne(self, item):
+        # identical to predict, but returns scalars
+        res = self.predict([item])
+        return {"mean": res["mean"].item(), "cov": res["cov"].item()}
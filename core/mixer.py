@@ -1,5 +1,5 @@
 from dsTypes import *
-from functools import reduce
+from functools import reduce, partial
 from snippet import Snippet
 from samplers import *
 import math
@@ -176,14 +176,17 @@ def nonDetWeightedObjFunc(x, snippets):
     return {"mean": sampleScore, "cov": distParams["cov"]}
 
 
-def multiObjSample(x0, snippets):
+def multiObjSample(x0, snippets, compiled=False):
     logger.mixer("Starting multi-objective sampler")
     # order snippets by filter size, randomize order of equal length snippets
     paramOrder = sorted(
         snippets, key=lambda snippet: len(snippet.filter) + random.random()
     )
 
-    fx0 = paramOrder[0].predictOne(x0)["mean"]
+    # scoring can go through the compiled (numpy-only) snippets
+    models = {s: s.compile() if compiled else s for s in snippets}
+
+    fx0 = models[paramOrder[0]].predictOne(x0)["mean"]
     logger.mixer(
         "Snippets randomized. First Snippet: {0} score: {1}".format(
             paramOrder[0].name, fx0
@@ -191,21 +194,30 @@ def multiObjSample(x0, snippets):
     )
 
     # sample one from the first snippet
-    sampler = Rejection(paramOrder[0], x0, threshold=fx0, n=1, limit=1000)
+    sampler = Rejection(
+        paramOrder[0], x0, threshold=fx0, n=1, limit=1000, compiled=compiled
+    )
     sampler.run()
     currentResult = sampler.results[0]["x"] if len(sampler.results) > 0 else x0
 
     # tracking history of snippet values
-    fxs = [paramOrder[0].predictOne(currentResult)["mean"]]
+    fxs = [models[paramOrder[0]].predictOne(currentResult)["mean"]]
 
     # for each subsequent thing, run this loop
     for i in range(1, len(paramOrder)):
         nextSnippet = paramOrder[i]
         # sample a thing from the next snippet
-        fxn = nextSnippet.predictOne(currentResult)["mean"]
+        fxn = models[nextSnippet].predictOne(currentResult)["mean"]
         logger.mixer("Next snippet: {0} score: {1}".format(nextSnippet.name, fxn))
 
-        samplerN = Rejection(nextSnippet, currentResult, threshold=fxn, n=1, limit=1000)
+        samplerN = Rejection(
+            nextSnippet,
+            currentResult,
+            threshold=fxn,
+            n=1,
+            limit=1000,
+            compiled=compiled,
+        )
         samplerN.run()
         nextResult = (
             samplerN.results[0]["x"] if len(samplerN.results) > 0 else currentResult
@@ -215,7 +227,7 @@ def multiObjSample(x0, snippets):
         fxs.append(fxn)
         nextFxs = []
         for j in range(0, len(fxs)):
-            nextFxs.append(paramOrder[j].predictOne(nextResult)["mean"])
+            nextFxs.append(models[paramOrder[j]].predictOne(nextResult)["mean"])
 
         # sum diffs
         previousScoreTotal = reduce(lambda a, b: a + b, fxs)
@@ -245,7 +257,7 @@ def multiObjSample(x0, snippets):
 def multiObjMix(snippets, params):
     results = []
     for i in range(0, params["n"]):
-        sample = multiObjSample(params["x0"], snippets)
+        sample = multiObjSample(params["x0"], snippets, params.get("compiled", False))
         sample["count"] = i
         sample["idx"] = i
         results.append(sample)
@@ -267,15 +279,22 @@ def mixWeightedObjFunc(snippets, params):
             if param not in paramFilter:
                 paramFilter.append(param)
 
+    # the objective only needs predictOne, so it can use the compiled snippets
+    if params.get("compiled", False):
+        snippets = [snippet.compile() for snippet in snippets]
+
     # the threshold here is really hard to just define absolutely
     # degenerate case probably happens when there is disagreement about goodness of
     # same parameter values
+    # the objective is a partial (not a lambda) so it can be sent to sampler workers
     sampler = GenericRejection(
         params["x0"],
         startPts,
-        lambda x: nonDetWeightedObjFunc(x, snippets),
+        partial(nonDetWeightedObjFunc, snippets=snippets),
         paramFilter,
         threshold=0.5,
+        batchSize=params.get("batchSize", 1),
+        workers=params.get("workers", 1),
     )
     sampler.start()
     sampler.join()
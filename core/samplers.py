@@ -9,12 +9,20 @@ import pyro
 import pyro.distributions as dist
 
 import numpy as np
-from scipy.stats import norm
 from scipy.optimize import minimize
 
 from functools import reduce
-from threading import Thread, Event
+from threading import Thread, Event, Lock
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import random
+import weakref
+import os
+import atexit
+import pickle
+import hashlib
+import tempfile
 
 # logging setup
 import logging
@@ -61,6 +69,194 @@ def checkSimilarity(x, accept, epsilon, df):
     return True
 
 
+# generates k candidate vectors based on x0. Each candidate copies the filtered params
+# from a random base point (rows of basePts), then replaces a random subset of freeParams
+# filtered params with uniform random values. Returns a (k, len(x0)) tensor.
+def generateCandidates(x0, basePts, filter, freeParams, k, generator=None):
+    filterIdx = torch.tensor(filter, dtype=torch.long)
+    xp = torch.tensor(x0, dtype=torch.get_default_dtype()).repeat(k, 1)
+
+    base = basePts[torch.randint(len(basePts), (k,), generator=generator)]
+    xp[:, filterIdx] = base[:, filterIdx]
+
+    # random subset per row: rank a uniform draw and keep the first freeParams
+    free = torch.rand(k, len(filter), generator=generator).argsort(dim=1)
+    cols = filterIdx[free[:, 0:freeParams]]
+    xp.scatter_(1, cols, torch.rand(k, cols.shape[1], generator=generator))
+
+    return xp
+
+
+# scores a block of candidates. evalFunc (one vector at a time) takes priority,
+# otherwise the whole block goes through a single snippet.predict call
+def scoreCandidates(xs, snippet=None, evalFunc=None):
+    if evalFunc:
+        return [evalFunc(x) for x in xs]
+
+    res = snippet.predict(xs)
+    return [
+        {"mean": mean, "cov": cov}
+        for mean, cov in zip(res["mean"].tolist(), res["cov"].tolist())
+    ]
+
+
+# long-lived pool of spawned worker processes, shared by the parallel samplers and
+# multi-start training. Workers import torch once and stay up between runs. The pool is
+# sized once (maxPoolWorkers, processes start on demand), callers limit their own use by
+# how many tasks they keep queued. It is only replaced if a worker died, a broken pool
+# has no work left to lose
+maxPoolWorkers = os.cpu_count() or 1
+workerPool = {"executor": None}
+workerPoolLock = Lock()
+
+
+def initPoolWorker():
+    # each worker is one core, don't let torch oversubscribe
+    torch.set_num_threads(1)
+
+
+def getWorkerPool():
+    with workerPoolLock:
+        executor = workerPool["executor"]
+        if executor is None or getattr(executor, "_broken", False):
+            workerPool["executor"] = ProcessPoolExecutor(
+                max_workers=maxPoolWorkers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=initPoolWorker,
+            )
+
+        return workerPool["executor"]
+
+
+# the snippet / eval function a sampler run scores with is pickled to a temp file once,
+# keyed by a digest of the pickle (snippets leave counters and lazy caches out of it).
+# Workers load it the first time they see the key, so a retrained snippet (new
+# modelVersion) or new eval function is pushed once per worker.
+# Files are reference counted by the sampler runs and queued blocks using them. Past
+# maxPayloadFiles, the least recently used unreferenced files are deleted
+payloadFiles = {}
+maxPayloadFiles = 8
+payloadLock = Lock()
+
+
+# stores the payload and takes a reference to it, returns its (key, path)
+def storeWorkerPayload(snippet, evalFunc):
+    data = pickle.dumps((snippet, evalFunc))
+    key = hashlib.sha1(data).hexdigest()
+
+    with payloadLock:
+        entry = payloadFiles.pop(key, None)
+        if entry is None:
+            fd, path = tempfile.mkstemp(prefix="dsPayload", suffix=".pkl")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            entry = {"path": path, "refs": 0}
+
+        entry["refs"] += 1
+        payloadFiles[key] = entry
+
+        unused = [k for k in payloadFiles if payloadFiles[k]["refs"] == 0]
+        for k in unused[0 : max(0, len(payloadFiles) - maxPayloadFiles)]:
+            removePayloadFile(k)
+
+        return key, entry["path"]
+
+
+def acquireWorkerPayload(key):
+    with payloadLock:
+        payloadFiles[key]["refs"] += 1
+
+
+def releaseWorkerPayload(key):
+    with payloadLock:
+        payloadFiles[key]["refs"] -= 1
+
+
+def removePayloadFile(key):
+    path = payloadFiles.pop(key)["path"]
+    if os.path.exists(path):
+        os.remove(path)
+
+
+@atexit.register
+def removePayloadFiles():
+    with payloadLock:
+        for key in list(payloadFiles):
+            removePayloadFile(key)
+
+
+# per-process state of pool workers: the payload currently loaded
+workerState = {"key": None}
+
+
+def loadWorkerPayload(key, path):
+    if workerState["key"] != key:
+        with open(path, "rb") as f:
+            workerState["snippet"], workerState["evalFunc"] = pickle.load(f)
+        workerState["key"] = key
+
+
+def sampleWorkerBlock(payload, x0, basePts, filter, freeParams, k, seed):
+    loadWorkerPayload(*payload)
+    generator = torch.Generator().manual_seed(seed)
+    xs = generateCandidates(x0, basePts, filter, freeParams, k, generator)
+    return xs, scoreCandidates(xs, workerState["snippet"], workerState["evalFunc"])
+
+
+# generates and scores candidate blocks in the shared worker pool.
+# Each worker loads its own copy of the snippet / eval function (they must be picklable),
+# and each block gets its own seed spawned from the sampler seed. Blocks are handed
+# back in submission order, so a run is reproducible for a given seed.
+class ParallelBlockSource:
+    def __init__(self, workers, seed=None, snippet=None, evalFunc=None):
+        self.workers = workers
+        self.seeds = np.random.SeedSequence(seed)
+        self.inflight = deque()
+        self.pool = getWorkerPool()
+        self.payload = storeWorkerPayload(snippet, evalFunc)
+
+    def nextBlock(self, x0, basePts, filter, freeParams, k):
+        while True:
+            # keep one block queued per worker
+            while len(self.inflight) < self.workers:
+                seed = int(self.seeds.spawn(1)[0].generate_state(1)[0])
+                acquireWorkerPayload(self.payload[0])
+                future = self.pool.submit(
+                    sampleWorkerBlock,
+                    self.payload,
+                    x0,
+                    basePts,
+                    filter,
+                    freeParams,
+                    k,
+                    seed,
+                )
+                future.add_done_callback(self.releaseBlock)
+                self.inflight.append((freeParams, future))
+
+            blockFreeParams, future = self.inflight.popleft()
+
+            # blocks generated under an old free param limit are thrown out
+            if blockFreeParams != freeParams:
+                future.cancel()
+                continue
+
+            xs, scores = future.result()
+            return deque(zip(xs, scores))
+
+    # every queued block holds a reference to the payload until it's done or cancelled
+    def releaseBlock(self, future):
+        releaseWorkerPayload(self.payload[0])
+
+    # the pool stays up. Queued blocks are cancelled, blocks already running finish in
+    # the background and their results are dropped
+    def close(self):
+        for blockFreeParams, future in self.inflight:
+            future.cancel()
+        self.inflight.clear()
+        releaseWorkerPayload(self.payload[0])
+
+
 class SamplerThread(Thread):
     def __init__(self):
         super().__init__()
@@ -92,6 +288,9 @@ class GenericRejection(SamplerThread):
         retries=20,
         cb=None,
         final=None,
+        batchSize=1,
+        workers=1,
+        seed=None,
     ):
         super().__init__()
         self.name = name
@@ -108,9 +307,35 @@ class GenericRejection(SamplerThread):
         self.evalFunc = evalFunc
         self.startingPts = startingPts
 
+        # blocks of candidates are generated and scored together, in the sampler
+        # thread or spread over worker processes (evalFunc must be picklable)
+        self.batchSize = max(1, int(batchSize))
+        self.workers = max(1, int(workers))
+        self.seed = seed
+
+        if self.workers > 1:
+            try:
+                pickle.dumps(evalFunc)
+            except Exception:
+                logger.warning(
+                    "[{0}] Eval function can't be pickled, sampling in one process".format(
+                        self.name
+                    )
+                )
+                self.workers = 1
+
         if self.freeParams > len(self.filter):
             self.freeParams = len(self.filter)
 
+    def sampleBlock(self, source, filter, basePts, freeParams):
+        if source:
+            return source.nextBlock(
+                self.x0, basePts, filter, freeParams, self.batchSize
+            )
+
+        xs = generateCandidates(self.x0, basePts, filter, freeParams, self.batchSize)
+        return deque(zip(xs, scoreCandidates(xs, evalFunc=self.evalFunc)))
+
     def run(self):
         logger.sample("[{0}] Generic Rejection sampler initializing".format(self.name))
         count = 0
@@ -120,11 +345,10 @@ class GenericRejection(SamplerThread):
         log = []
         currentFreeParams = self.freeParams
 
-        # duplicate, we're going to shuffle it a lot
         filter = list(self.filter)
-
-        # generic sampler still uses torch cause it's easy to generate random dists from it
-        g = dist.Uniform(torch.zeros(len(filter)), torch.ones(len(filter)))
+        basePts = torch.tensor(self.startingPts, dtype=torch.get_default_dtype())
+        pending = deque()
+        seen = set()
 
         logger.sample("[{0}] Filter: {1}".format(self.name, filter))
         logger.sample(
@@ -134,35 +358,37 @@ class GenericRejection(SamplerThread):
             "[{0}] Initial Point Count: {1}".format(self.name, len(self.startingPts))
         )
         logger.sample("[{0}] Free Param Floor: {1}".format(self.name, self.paramFloor))
+        logger.sample(
+            "[{0}] Batch Size: {1}, Workers: {2}".format(
+                self.name, self.batchSize, self.workers
+            )
+        )
+
+        source = None
+        if self.workers > 1:
+            source = ParallelBlockSource(
+                self.workers, self.seed, evalFunc=self.evalFunc
+            )
+            logger.sample(
+                "[{0}] Worker seed: {1}".format(self.name, source.seeds.entropy)
+            )
 
         while count < self.n:
             if self.stopped():
                 logger.sample("[{0}] Rejection Sampler early stop".format(self.name))
                 break
 
-            # determine which parameters are fixed (randomly select from the filter params)
-            random.shuffle(filter)
-            selected = filter[0:currentFreeParams]
-
-            # pull a random positive example to use as the base
-            random.shuffle(self.startingPts)
-            xp = torch.tensor(self.x0)
-            for i in range(len(filter)):
-                xp[filter[i]] = self.startingPts[0][filter[i]]
-
-            # drop in replace the modified params
-            randVec = g.sample()
+            if len(pending) == 0:
+                pending = self.sampleBlock(source, filter, basePts, currentFreeParams)
 
-            for i in range(len(selected)):
-                xp[selected[i]] = randVec[i]
-
-            # eval (expects return of mean and cov)
-            score = self.evalFunc(xp)
+            xp, score = pending.popleft()
 
             logger.debug("[{0}] Sample Generated. Score: {1}".format(self.name, score))
 
-            # check score
-            if score["mean"] > self.threshold:
+            # check score, duplicates are rejected
+            key = tuple(xp.tolist())
+            if score["mean"] > self.threshold and key not in seen:
+                seen.add(key)
                 logger.sample(
                     "[{0}/{1}] Accepted {2} mean score: {3}".format(
                         count + 1, self.n, xp, score["mean"]
@@ -198,6 +424,7 @@ class GenericRejection(SamplerThread):
 
                 if currentFreeParams < self.freeParams:
                     currentFreeParams = currentFreeParams + 1
+                    pending.clear()
                     logger.sample(
                         "[{0}] Sample accepted. Raising free param limit to {1}.".format(
                             self.name, currentFreeParams
@@ -220,12 +447,16 @@ class GenericRejection(SamplerThread):
                 if (attempts > self.retries) & (currentFreeParams > self.paramFloor):
                     currentFreeParams = currentFreeParams - 1
                     attempts = 0
+                    pending.clear()
                     logger.sample(
                         "[{0}] Retry limit reached. Decreasing free params to {1}".format(
                             self.name, currentFreeParams
                         )
                     )
 
+        if source:
+            source.close()
+
         # finalize
         logger.sample("[{0}] Finalizing sampler".format(self.name))
         logger.sample(
@@ -263,6 +494,10 @@ class Rejection(SamplerThread):
         thresholdEvalMode="gt",
         thresholdTarget=None,
         scoreDelta=0,
+        batchSize=1,
+        workers=1,
+        seed=None,
+        compiled=False,
     ):
         super().__init__()
         self.snippet = snippet
@@ -297,6 +532,19 @@ class Rejection(SamplerThread):
         # if it's 0, the check is skipped
         self.scoreDelta = scoreDelta
 
+        # number of candidates generated and scored together. Candidates are still
+        # checked one at a time, so the accept order and trace match the unbatched sampler
+        self.batchSize = max(1, int(batchSize))
+
+        # blocks can also be spread over worker processes, each with a copy of the snippet
+        # and its own seeded random stream
+        self.workers = max(1, int(workers))
+        self.seed = seed
+
+        # candidates are scored by the numpy-only compiled snippet instead of the full
+        # model. It's also much smaller to send to worker processes
+        self.model = snippet.compile() if compiled else snippet
+
     def setThresholdFunc(self):
         # standard greater than
         if self.thresholdEvalMode == "gt":
@@ -326,6 +574,17 @@ class Rejection(SamplerThread):
         )
         return reduce(lambda x, y: x and y, scoreAboveThresh)
 
+    # generates and scores a block of batchSize candidates, locally or from the worker pool
+    # returns a queue of (x, score) pairs in generation order
+    def sampleBlock(self, source, filter, basePts, freeParams):
+        if source:
+            return source.nextBlock(
+                self.x0, basePts, filter, freeParams, self.batchSize
+            )
+
+        xs = generateCandidates(self.x0, basePts, filter, freeParams, self.batchSize)
+        return deque(zip(xs, scoreCandidates(xs, self.model, self.customEval)))
+
     def run(self):
         logger.sample("[{0}] Rejection sampler initializing".format(self.name))
         count = 0
@@ -352,8 +611,9 @@ class Rejection(SamplerThread):
         #             filter.remove(elem)
 
         posExamples = self.snippet.posExamples()
-
-        g = dist.Uniform(torch.zeros(len(filter)), torch.ones(len(filter)))
+        basePts = torch.tensor(posExamples, dtype=torch.get_default_dtype())
+        pending = deque()
+        seen = set()
 
         logger.sample("[{0}] Filter: {1}".format(self.name, filter))
         logger.sample(
@@ -363,34 +623,31 @@ class Rejection(SamplerThread):
             "[{0}] Positive Example Count: {1}".format(self.name, len(posExamples))
         )
         logger.sample("[{0}] Free Param Floor: {1}".format(self.name, self.paramFloor))
+        logger.sample(
+            "[{0}] Batch Size: {1}, Workers: {2}".format(
+                self.name, self.batchSize, self.workers
+            )
+        )
+
+        source = None
+        if self.workers > 1:
+            source = ParallelBlockSource(
+                self.workers, self.seed, self.model, self.customEval
+            )
+            logger.sample(
+                "[{0}] Worker seed: {1}".format(self.name, source.seeds.entropy)
+            )
 
         while count < self.n and attempts < self.limit:
             if self.stopped():
                 logger.sample("[{0}] Rejection Sampler early stop".format(self.name))
                 break
 
-            # determine which parameters are fixed (randomly select from the filter params)
-            random.shuffle(filter)
-            selected = filter[0:currentFreeParams]
+            # candidates are generated in blocks, then consumed in order
+            if len(pending) == 0:
+                pending = self.sampleBlock(source, filter, basePts, currentFreeParams)
 
-            # pull a random positive example to use as the base
-            random.shuffle(posExamples)
-            xp = torch.tensor(self.x0)
-            for i in range(len(filter)):
-                xp[filter[i]] = posExamples[0][filter[i]]
-
-            # drop in replace the modified params
-            randVec = g.sample()
-
-            for i in range(len(selected)):
-                xp[selected[i]] = randVec[i]
-
-            # eval
-            score = 0
-            if self.customEval:
-                score = self.customEval(xp)
-            else:
-                score = self.snippet.predictOne(xp)
+            xp, score = pending.popleft()
 
             logger.debug(
                 "[{0}] Sample Generated. Mean Score: {1}".format(
@@ -398,10 +655,14 @@ class Rejection(SamplerThread):
                 )
             )
 
-            # check score
-            if self.thresholdFunc(score["mean"]) and self.scoreDiff(
-                score["mean"], accept
+            # check score, duplicates are rejected
+            key = tuple(xp.tolist())
+            if (
+                self.thresholdFunc(score["mean"])
+                and self.scoreDiff(score["mean"], accept)
+                and key not in seen
             ):
+                seen.add(key)
                 logger.sample(
                     "[{0}/{1}] Accepted {2} mean score: {3}".format(
                         count + 1, self.n, xp, score["mean"]
@@ -437,6 +698,8 @@ class Rejection(SamplerThread):
 
                 if currentFreeParams < int(self.freeParams):
                     currentFreeParams = int(self.freeParams)
+                    # rest of the block was generated with the old limit
+                    pending.clear()
                     logger.sample(
                         "[{0}] Sample accepted. Raising free param limit to {1}.".format(
                             self.name, currentFreeParams
@@ -459,12 +722,16 @@ class Rejection(SamplerThread):
                 if (attempts > self.retries) & (currentFreeParams > self.paramFloor):
                     currentFreeParams = currentFreeParams - 1
                     attempts = 0
+                    pending.clear()
                     logger.sample(
                         "[{0}] Retry limit reached. Decreasing free params to {1}".format(
                             self.name, currentFreeParams
                         )
                     )
 
+        if source:
+            source.close()
+
         # finalize
         logger.sample("[{0}] Finalizing sampler".format(self.name))
         logger.sample(
@@ -498,6 +765,8 @@ class Metropolis(SamplerThread):
         scale=0.05,
         cb=None,
         final=None,
+        chains=1,
+        compiled=False,
     ):
         super().__init__()
         self.f = f
@@ -513,10 +782,19 @@ class Metropolis(SamplerThread):
         self.name = name
         self.final = final
 
+        # number of chains advanced together. More than one chain uses the batched sampler
+        self.chains = max(1, int(chains))
+
+        # proposals are scored by the numpy-only compiled snippet instead of the full model
+        self.model = f.compile() if compiled else f
+
     def run(self):
+        if self.chains > 1:
+            return self.runChains()
+
         # initialize
         logger.sample("[{0}] Metropolis sampler initializing".format(self.name))
-        fx = self.f.predictOne(self.x0)
+        fx = self.model.predictOne(self.x0)
         x = torch.tensor(self.x0)
         count = 0
         accept = []
@@ -546,7 +824,7 @@ class Metropolis(SamplerThread):
             # bounds (assuming normalized, if not will need a key)
             xp = torch.clamp(xp, 0.0, 1.0)
 
-            fxp = self.f.predict(xp.view(-1, 1).t())
+            fxp = self.model.predict(xp.view(-1, 1).t())
             fxp["mean"] = fxp["mean"].item()
             fxp["cov"] = fxp["cov"].item()
 
@@ -614,6 +892,234 @@ class Metropolis(SamplerThread):
 
         return accept
 
+    # scores a (chains, dims) tensor, compiled snippet output is converted back to tensors
+    def predictChains(self, x):
+        res = self.model.predict(x)
+        return {
+            "mean": torch.as_tensor(res["mean"], dtype=x.dtype),
+            "cov": torch.as_tensor(res["cov"], dtype=x.dtype),
+        }
+
+    # advances all chains together as one (chains, dims) tensor. Each step scores every
+    # proposal in one predict call. Burn-in, stride and qMin are tracked per chain, and a
+    # chain only moves when its proposal is kept as a result (same rule as the single chain).
+    def runChains(self):
+        logger.sample(
+            "[{0}] Metropolis sampler initializing {1} chains".format(
+                self.name, self.chains
+            )
+        )
+        m = self.chains
+        filterIdx = torch.tensor(self.f.filter, dtype=torch.long)
+        x = torch.tensor(self.x0, dtype=torch.get_default_dtype()).repeat(m, 1)
+        fx = self.predictChains(x)["mean"]
+        counts = torch.zeros(m, dtype=torch.long)
+        accept = []
+        acceptX = x.new_empty(0, x.shape[1])
+
+        # same proposal as the single chain sampler, N(0, scale * I) on the filtered params
+        sd = self.scale**0.5
+
+        logger.sample("[{0} Metropolis sampler starting".format(self.name))
+        while (counts < self.limit).any() and len(accept) < self.n:
+            if self.stopped():
+                logger.sample("[{0}] Metropolis sampler early stop".format(self.name))
+                break
+
+            active = counts < self.limit
+
+            xp = x.clone()
+            xp[:, filterIdx] = xp[:, filterIdx] + torch.randn(m, len(filterIdx)) * sd
+            xp = torch.clamp(xp, 0.0, 1.0)
+
+            fxp = self.predictChains(xp)
+            a = fxp["mean"] / fx
+            a[fx == 0] = 1
+
+            moved = (torch.rand(m) < a) & active
+            counts = counts + moved.long()
+
+            # idx is the running count of moves over all chains, unique per move
+            moveIdx = int(counts.sum()) - moved.sum() + torch.cumsum(moved.long(), 0)
+
+            keep = (
+                moved
+                & (counts > self.burn)
+                & (counts % self.stride == 0)
+                & (fxp["mean"] > self.qMin)
+            )
+
+            for i in keep.nonzero().view(-1).tolist():
+                # acceptance check against everything kept so far
+                if len(acceptX) > 0:
+                    minDist = torch.cdist(xp[i : i + 1], acceptX).min().item()
+                    if minDist < self.epsilon:
+                        continue
+
+                mean = fxp["mean"][i].item()
+                cov = fxp["cov"][i].item()
+                idx = moveIdx[i].item()
+
+                logger.sample(
+                    "[{0}/{1} chain: {2} ct: {3}] Accepted {4} mean: {5}".format(
+                        len(accept) + 1, self.n, i, counts[i].item(), xp[i], mean
+                    )
+                )
+
+                if self.cb:
+                    self.cb({"x": xp[i].tolist(), "mean": mean, "cov": cov, "idx": idx})
+
+                accept.append(
+                    {"x": xp[i].tolist(), "mean": mean, "cov": cov, "idx": idx}
+                )
+                acceptX = torch.cat([acceptX, xp[i : i + 1]])
+
+                x[i] = xp[i]
+                fx[i] = fxp["mean"][i]
+
+                if len(accept) >= self.n:
+                    break
+
+        # final callback
+        if self.final:
+            self.final(accept, self.name)
+
+        return accept
+
+
+# thompson sampling: each iteration draws a batch of functions from the snippet
+# posterior (see Snippet.posteriorDraws), scores one shared block of candidates under
+# every draw and keeps the best candidate per draw. Candidates closer than epsilon to
+# something already kept are skipped, so each draw returns a different design.
+# Only works for RBF and RFF snippets.
+class Thompson(SamplerThread):
+    def __init__(
+        self,
+        snippet,
+        x0,
+        name="",
+        n=10,
+        draws=8,
+        candidates=2048,
+        freeParams=1000,
+        epsilon=0.1,
+        limit=1000,
+        cb=None,
+        final=None,
+    ):
+        super().__init__()
+        self.snippet = snippet
+        self.x0 = x0
+        self.name = name
+        self.n = n
+        self.draws = max(1, int(draws))
+        self.candidates = candidates
+        self.freeParams = min(freeParams, len(snippet.filter))
+        self.epsilon = epsilon
+        self.limit = limit
+        self.cb = cb
+        self.final = final
+        self.results = None
+
+    def run(self):
+        logger.sample("[{0}] Thompson sampler initializing".format(self.name))
+        filter = list(self.snippet.filter)
+        posExamples = self.snippet.posExamples()
+        if len(posExamples) == 0:
+            posExamples = [self.x0]
+
+        basePts = torch.tensor(posExamples, dtype=torch.get_default_dtype())
+        accept = []
+        acceptX = basePts.new_empty(0, basePts.shape[1])
+        drawn = 0
+
+        if self.snippet.trainedMode not in ["RBF", "RFF"]:
+            logger.warning(
+                "[{0}] Thompson sampler needs an RBF or RFF snippet, trained mode is {1}".format(
+                    self.name, self.snippet.trainedMode
+                )
+            )
+            drawn = self.limit
+
+        logger.sample(
+            "[{0}] Draws: {1}, Candidates: {2}".format(
+                self.name, self.draws, self.candidates
+            )
+        )
+
+        while len(accept) < self.n and drawn < self.limit:
+            if self.stopped():
+                logger.sample("[{0}] Thompson sampler early stop".format(self.name))
+                break
+
+            count = int(min(self.draws, self.limit - drawn, self.n - len(accept)))
+            f = self.snippet.posteriorDraws(count)
+            xs = generateCandidates(
+                self.x0, basePts, filter, self.freeParams, self.candidates
+            )
+            values = f(xs)
+
+            # candidates too close to anything kept are out for every draw
+            allowed = torch.ones(len(xs), dtype=torch.bool)
+            if len(acceptX) > 0:
+                allowed = torch.cdist(xs, acceptX).min(dim=1).values >= self.epsilon
+
+            chosen = []
+            for j in range(count):
+                if not allowed.any():
+                    break
+
+                i = values[:, j].masked_fill(~allowed, float("-inf")).argmax().item()
+                chosen.append(i)
+                allowed = allowed & (
+                    torch.cdist(xs, xs[i : i + 1]).view(-1) >= self.epsilon
+                )
+
+            if len(chosen) > 0:
+                # posterior mean / variance of all picks in one predict call
+                xp = xs[chosen]
+                res = self.snippet.predict(xp)
+
+                for k in range(len(chosen)):
+                    result = {
+                        "x": xp[k].tolist(),
+                        "mean": res["mean"][k].item(),
+                        "cov": res["cov"][k].item(),
+                        "idx": drawn + k,
+                    }
+                    logger.sample(
+                        "[{0}/{1} draw: {2}] Accepted {3} mean: {4}".format(
+                            len(accept) + 1,
+                            self.n,
+                            drawn + k,
+                            result["x"],
+                            result["mean"],
+                        )
+                    )
+
+                    if self.cb:
+                        self.cb(result)
+
+                    accept.append(result)
+
+                acceptX = torch.cat([acceptX, xp])
+
+            drawn = drawn + count
+
+        self.results = accept
+
+        # final callback
+        if self.final:
+            self.final(accept, self.name)
+
+        return accept
+
+
+# all-parameter models used by the Bootstrapper, one per snippet.
+# entries are dropped along with the snippet they were trained from
+allParamModels = weakref.WeakKeyDictionary()
+allParamLock = Lock()
+
 
 # the bootstrapper sampler attempts to determine which points should
 # be sampled next in order to gain maximal info about the expressed preferences
@@ -621,7 +1127,7 @@ class Metropolis(SamplerThread):
 # go back and re-write them
 # Borrowed primarily from: http://krasserm.github.io/2018/03/21/bayesian-optimization/
 class Bootstrapper(SamplerThread):
-    def __init__(self, f, x0, name="", n=10, cb=None, final=None):
+    def __init__(self, f, x0, name="", n=10, cb=None, final=None, optSteps=200):
         super().__init__()
         self.f = f
         self.x0 = x0
@@ -629,6 +1135,35 @@ class Bootstrapper(SamplerThread):
         self.cb = cb
         self.name = name
         self.final = final
+        self.optSteps = optSteps
+        self.model = None
+
+    # returns a copy of the snippet trained on all parameters. The copy is cached per
+    # snippet and reused until the training data changes, the snippet itself is not modified
+    def getAllParamModel(self):
+        key = (self.f.dataVersion, len(self.x0), self.optSteps)
+
+        with allParamLock:
+            cached = allParamModels.get(self.f)
+            if cached is not None and cached["key"] == key:
+                logger.sample(
+                    "[Bootstrap] Using cached all-parameter model for snippet {0}".format(
+                        self.name
+                    )
+                )
+                return cached["model"]
+
+            logger.sample(
+                "[Bootstrap] Training all-parameter model for snippet {0}".format(
+                    self.name
+                )
+            )
+            model = self.f.clone()
+            model.optSteps = self.optSteps  # quick opt
+            model.train(customFilter=list(range(0, len(self.x0))))
+            allParamModels[self.f] = {"key": key, "model": model}
+
+            return model
 
     def unfilter(self, subset, x):
         xp = list(self.x0)
@@ -637,52 +1172,77 @@ class Bootstrapper(SamplerThread):
 
         return xp
 
-    def expectedImprovement(self, X, xi=0.01):
-        # untested, need to check types, original written assuming numpy
-        # in this function, called from minObj in proposeLocation, it is assumed
-        # that the vectors are the proper length (all params)
-        pred = self.f.predictOne(X)
+    # expected improvement for each row of X (full length vectors) as a differentiable
+    # torch function, so the optimizer gets exact gradients instead of finite differences
+    def expectedImprovementTensor(self, X, xi=0.01):
+        pred = self.model.predictTensor(X)
         mean = pred["mean"]
         sigma = pred["cov"]
 
-        with np.errstate(divide="warn"):
-            # meanSampleOpt is cached at start of sampler (invariant during run, gpr does not change)
-            imp = mean - self.meanSampleOpt - xi
-            Z = imp / sigma
-            ei = imp * norm.cdf(Z) + sigma * norm.pdf(Z)
+        # meanSampleOpt is cached at start of sampler (invariant during run, gpr does not change)
+        imp = mean - self.meanSampleOpt - xi
+        Z = imp / sigma.clamp_min(1e-12)
+        normal = torch.distributions.Normal(0.0, 1.0)
+        ei = imp * normal.cdf(Z) + sigma * torch.exp(normal.log_prob(Z))
 
-            if sigma == 0.0:
-                ei = 0.0
+        return torch.where(sigma > 0, ei, torch.zeros_like(ei))
 
-        return ei
+    def expectedImprovement(self, X, xi=0.01):
+        # it is assumed that the vectors are the proper length (all params)
+        with torch.no_grad():
+            ei = self.expectedImprovementTensor(
+                torch.tensor([X], dtype=torch.get_default_dtype()), xi
+            )
+
+        return ei.item()
 
     def proposeLocation(self, subset, bounds=[0, 1], restarts=5):
-        # again, needs tests for types, may need torch -> numpy conversion
         # the gpr has been re-trained to include all parameters in this search
         # in this case, I want to limit which parameters get used in the optimization,
-        # so we'll retrieve the data and use our own subset thing to re-filter
-        # the data
-        acquisition = self.expectedImprovement
+        # so only the subset params are optimized and the rest are held at x0
         dim = len(subset)
-        bounds = np.array([[0, 1]] * dim)
-        minVal = 1
-        minX = None
-
-        # assumes X is a subset limited vector
-        def minObj(X):
-            # replace x0 subset indices with values from x
-            # duplicate
-            xp = self.unfilter(subset, X)
-            return -acquisition(xp)
-
-        for x0 in np.random.uniform(bounds[:, 0], bounds[:, 1], size=(restarts, dim)):
-            res = minimize(minObj, x0=x0, bounds=bounds, method="L-BFGS-B")
-            if res.fun < minVal:
-                minVal = res.fun
-                minX = res.x
-
-        logger.sample("[Bootstrap] impovement {0}".format(-minVal))
-        return minX.reshape(-1).tolist()
+        if dim == 0:
+            return []
+
+        subsetIdx = torch.tensor(subset, dtype=torch.long)
+        base = torch.tensor(self.x0, dtype=torch.get_default_dtype()).repeat(
+            restarts, 1
+        )
+
+        # all restarts are optimized as one problem. The objective is the sum of each
+        # restart's -EI, so the gradient for a restart only depends on its own row
+        def minObj(flatX):
+            X = torch.tensor(
+                flatX.reshape(restarts, dim),
+                dtype=torch.get_default_dtype(),
+                requires_grad=True,
+            )
+            xp = base.clone()
+            xp[:, subsetIdx] = X
+            loss = -self.expectedImprovementTensor(xp).sum()
+            loss.backward()
+
+            return loss.item(), X.grad.numpy().astype(np.float64).reshape(-1)
+
+        x0 = np.random.uniform(bounds[0], bounds[1], size=(restarts, dim))
+        res = minimize(
+            minObj,
+            x0=x0.reshape(-1),
+            jac=True,
+            bounds=[(bounds[0], bounds[1])] * (restarts * dim),
+            method="L-BFGS-B",
+        )
+
+        # pick the best restart
+        X = torch.tensor(res.x.reshape(restarts, dim), dtype=torch.get_default_dtype())
+        xp = base.clone()
+        xp[:, subsetIdx] = X
+        with torch.no_grad():
+            ei = self.expectedImprovementTensor(xp)
+        best = torch.argmax(ei).item()
+
+        logger.sample("[Bootstrap] impovement {0}".format(ei[best].item()))
+        return X[best].tolist()
 
     def initFrequencyTable(self):
         logger.sample("[Bootstrap] Initializing parameter frequency table")
@@ -691,9 +1251,9 @@ class Bootstrapper(SamplerThread):
         defaultFilter = self.f.getDefaultFilter()
         self.frequencies = [1] * dim
 
-        for pt in self.f.data:
-            if len(pt.affected) > 0:
-                for idx in pt.affected:
+        for affected in self.f.dataAffected:
+            if len(affected) > 0:
+                for idx in affected:
                     self.frequencies[idx] = self.frequencies[idx] + 1
             else:
                 for idx in defaultFilter:
@@ -724,18 +1284,17 @@ class Bootstrapper(SamplerThread):
         # all parameters, and then optimizations should proceed based on that
         # there could maybe be a mode that just uses the existing parameter set, but for
         # now I'll assume this is also about parameter exploration
-        logger.sample(
-            "[Bootstrap] Re-training snippet {0} on all parameters".format(self.name)
-        )
-        self.f.optSteps = 200  # quick opt
-        self.f.train(customFilter=list(range(0, len(self.x0))))
-        logger.sample("[Bootstrap] Re-training complete. Sampler starting.")
+        #
+        # the all-parameter model is kept separate from the snippet (and cached), so the
+        # snippet's own filter and model are untouched
+        self.model = self.getAllParamModel()
+        logger.sample("[Bootstrap] All-parameter model ready. Sampler starting.")
 
         # precompute some things
         logger.sample("[Bootstrap] Computing current max training data value")
 
-        XSample = self.f.getXTrain()
-        sampleMean = self.f.predict(XSample)["mean"]
+        XSample = self.model.getXTrain()
+        sampleMean = self.model.predict(XSample)["mean"]
         self.meanSampleOpt = torch.max(sampleMean).item()
 
         logger.sample(
@@ -751,7 +1310,7 @@ class Bootstrapper(SamplerThread):
         logger.sample("[Bootstrap] Finding maximal info point for default subset")
         firstSubset = self.f.getDefaultFilter()
         p1 = self.proposeLocation(firstSubset)
-        fp1 = self.f.predictOne(self.unfilter(firstSubset, p1))
+        fp1 = self.model.predictOne(self.unfilter(firstSubset, p1))
         if self.cb:
             self.cb(
                 {
@@ -787,7 +1346,7 @@ class Bootstrapper(SamplerThread):
             # for now: assume this is an initialized snippet
             proposed = self.proposeLocation(subset)
 
-            fp = self.f.predictOne(self.unfilter(subset, proposed))
+            fp = self.model.predictOne(self.unfilter(subset, proposed))
             if self.cb:
                 self.cb(
                     {
@@ -809,5 +1368,4 @@ class Bootstrapper(SamplerThread):
             i = i + 1
 
         # todo: stop returning 0
-        # todo: reload initial training settings after running this sampler
         return 0
@@ -1,14 +1,19 @@
 from dsTypes import *
 from samplers import *
-from functools import reduce
 import os
 import torch
 import math
 import random
 import gpytorch
 import sys
+import copy
 
 import graphUtils
+from inference import CompiledSnippet
+from collections import OrderedDict, deque
+from threading import Lock
+import multiprocessing
+import numpy as np
 
 # what if design intent is just sampling from the prior distribution over the preference function
 
@@ -20,46 +25,386 @@ import graphUtils
 # torch.cuda.init()
 
 
+# ARD RBF kernel that can cache the per-dimension squared differences of the training
+# inputs, as an (N^2, dims) matrix. While training, the kernel over the cached inputs is
+# one reduction of the cache against the inverse squared lengthscales instead of
+# rescaling the inputs and recomputing distances every step. Any other input is computed
+# as usual. The cache is never copied or saved with the model
+class CachedRBFKernel(gpytorch.kernels.RBFKernel):
+    def __init__(self, **kwargs):
+        super(CachedRBFKernel, self).__init__(**kwargs)
+        self.cache = None
+        self.cacheKey = None
+
+    # builds the cache for X if it fits in budget bytes, returns whether it did
+    def setCache(self, X, budget):
+        self.clearCache()
+        if X.shape[0] ** 2 * X.shape[1] * X.element_size() > budget:
+            return False
+
+        self.cache = (X.unsqueeze(1) - X.unsqueeze(0)).pow(2).view(-1, X.shape[1])
+        self.cacheKey = (X.data_ptr(), X.shape, X.dtype)
+        return True
+
+    def clearCache(self):
+        self.cache = None
+        self.cacheKey = None
+
+    def forward(self, x1, x2, diag=False, **params):
+        if (
+            self.cache is not None
+            and not diag
+            and not params.get("last_dim_is_batch", False)
+            and (x1.data_ptr(), x1.shape, x1.dtype) == self.cacheKey
+            and (x2.data_ptr(), x2.shape, x2.dtype) == self.cacheKey
+        ):
+            n = x1.shape[0]
+            weights = self.lengthscale.pow(-2).view(-1, 1)
+            return torch.exp(-0.5 * (self.cache @ weights).view(n, n))
+
+        return super(CachedRBFKernel, self).forward(x1, x2, diag=diag, **params)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["cache"] = None
+        state["cacheKey"] = None
+        return state
+
+
 class ExactGPModel(gpytorch.models.ExactGP):
     def __init__(self, train_x, train_y, likelihood, num_dims):
         super(ExactGPModel, self).__init__(train_x, train_y, likelihood)
         self.mean_module = gpytorch.means.ConstantMean()
-        # self.base_covar_module = gpytorch.kernels.ScaleKernel(
-        #     gpytorch.kernels.RBFKernel()
-        # )
-        # self.covar_module = gpytorch.kernels.InducingPointKernel(
-        #     self.base_covar_module,
-        #     inducing_points=train_x[:100, :],
-        #     likelihood=likelihood,
-        # )
         self.covar_module = gpytorch.kernels.ScaleKernel(
-            gpytorch.kernels.RBFKernel(ard_num_dims=num_dims)
+            CachedRBFKernel(ard_num_dims=num_dims)
         )
 
+        # diagonal added to the prior covariance. A buffer so it's saved with the state,
+        # training raises it if the covariance isn't positive definite
+        self.register_buffer("jitter", torch.tensor(1e-4))
+
     def forward(self, x):
         mean_x = self.mean_module(x)
         covar_x = self.covar_module(x)
-        covar_x = covar_x + torch.eye(covar_x.size(0), covar_x.size(1)) * 1e-4
+        covar_x = covar_x + torch.eye(
+            covar_x.size(0), covar_x.size(1), dtype=covar_x.dtype
+        ) * self.jitter.to(covar_x.dtype)
+        return gpytorch.distributions.MultivariateNormal(mean_x, covar_x)
+
+
+# SGPR: exact GP over an inducing point (Nystrom) approximation of the RBF kernel.
+# Training is O(N M^2) for M inducing points, the inducing locations are learned
+class SGPRModel(gpytorch.models.ExactGP):
+    def __init__(self, train_x, train_y, likelihood, num_dims, inducing):
+        super(SGPRModel, self).__init__(train_x, train_y, likelihood)
+        self.mean_module = gpytorch.means.ConstantMean()
+        self.base_covar_module = gpytorch.kernels.ScaleKernel(
+            gpytorch.kernels.RBFKernel(ard_num_dims=num_dims)
+        )
+        self.covar_module = gpytorch.kernels.InducingPointKernel(
+            self.base_covar_module, inducing_points=inducing, likelihood=likelihood
+        )
+        self.register_buffer("jitter", torch.tensor(1e-4))
+
+    def forward(self, x):
+        mean_x = self.mean_module(x)
+        covar_x = self.covar_module(x).add_jitter(self.jitter.item())
+        return gpytorch.distributions.MultivariateNormal(mean_x, covar_x)
+
+
+# SVGP: variational GP with M learned inducing points, trained on minibatches.
+# The likelihood is a submodule so its noise is part of the state dict, like the exact model
+class SVGPModel(gpytorch.models.ApproximateGP):
+    def __init__(self, likelihood, num_dims, inducing):
+        variationalDist = gpytorch.variational.CholeskyVariationalDistribution(
+            inducing.size(0)
+        )
+        variationalStrategy = gpytorch.variational.VariationalStrategy(
+            self, inducing, variationalDist, learn_inducing_locations=True
+        )
+        super(SVGPModel, self).__init__(variationalStrategy)
+        self.likelihood = likelihood
+        self.mean_module = gpytorch.means.ConstantMean()
+        self.covar_module = gpytorch.kernels.ScaleKernel(
+            gpytorch.kernels.RBFKernel(ard_num_dims=num_dims)
+        )
+        self.register_buffer("jitter", torch.tensor(1e-4))
+
+    def forward(self, x):
+        mean_x = self.mean_module(x)
+        covar_x = self.covar_module(x).add_jitter(self.jitter.item())
+        return gpytorch.distributions.MultivariateNormal(mean_x, covar_x)
+
+
+# RFF: exact GP over a random fourier feature approximation of the RBF kernel, with
+# features random frequencies. The kernel is low rank, training is O(N F^2)
+class RFFModel(gpytorch.models.ExactGP):
+    def __init__(self, train_x, train_y, likelihood, num_dims, features):
+        super(RFFModel, self).__init__(train_x, train_y, likelihood)
+        self.mean_module = gpytorch.means.ConstantMean()
+        self.covar_module = gpytorch.kernels.ScaleKernel(
+            gpytorch.kernels.RFFKernel(
+                features, num_dims=num_dims, ard_num_dims=num_dims
+            )
+        )
+        self.register_buffer("jitter", torch.tensor(1e-4))
+
+    def forward(self, x):
+        mean_x = self.mean_module(x)
+        covar_x = self.covar_module(x).add_jitter(self.jitter.item())
         return gpytorch.distributions.MultivariateNormal(mean_x, covar_x)
 
 
+# hyperparameters of a batch of exact RBF models, one per snippet. Module names match
+# ExactGPModel so parameters line up with each snippet's state dict
+class BatchGPModel(gpytorch.Module):
+    def __init__(self, batch, num_dims):
+        super(BatchGPModel, self).__init__()
+        shape = torch.Size([batch])
+        self.likelihood = gpytorch.likelihoods.GaussianLikelihood(batch_shape=shape)
+        self.mean_module = gpytorch.means.ConstantMean(batch_shape=shape)
+        self.covar_module = gpytorch.kernels.ScaleKernel(
+            gpytorch.kernels.RBFKernel(ard_num_dims=num_dims, batch_shape=shape),
+            batch_shape=shape,
+        )
+        self.jitter = 1e-4
+
+    # negative exact marginal log likelihood / N of every model, (batch,).
+    # X (batch, N, dims) and y (batch, N) are padded to the largest N, mask marks the
+    # real rows. Padded rows get unit variance, no covariance and a zero residual, so
+    # they don't change the loss or its gradients.
+    def loss(self, X, y, mask):
+        n = mask.sum(dim=1)
+        pair = mask.unsqueeze(2) * mask.unsqueeze(1)
+        diag = mask * (self.jitter + self.likelihood.noise) + (1 - mask)
+        K = self.covar_module(X).to_dense() * pair + torch.diag_embed(diag)
+        r = (y - self.mean_module(X)) * mask
+
+        L = torch.linalg.cholesky(K)
+        a = torch.cholesky_solve(r.unsqueeze(-1), L).squeeze(-1)
+        logDet = L.diagonal(dim1=1, dim2=2).log().sum(dim=1)
+        return (0.5 * (r * a).sum(dim=1) + logDet) / n + 0.5 * math.log(2 * math.pi)
+
+
+# entry of a saved state dict ending in suffix (e.g. the inducing points or random
+# frequencies of an approximate model), None if there isn't one
+def stateEntry(state, suffix):
+    for key in state:
+        if key.endswith(suffix):
+            return state[key]
+
+    return None
+
+
+# state dict restricted to the filtered params at indices keep: lengthscales, inducing
+# point columns and RFF frequency rows are sliced, everything else is shared
+def pruneState(state, keep):
+    idx = torch.tensor(keep, dtype=torch.long)
+    pruned = {}
+    for key, value in state.items():
+        if key.endswith("raw_lengthscale") or key.endswith("inducing_points"):
+            value = value[..., idx]
+        elif key.endswith("randn_weights"):
+            value = value[idx]
+        pruned[key] = value
+
+    return pruned
+
+
+# kernel mode of the model a saved state dict was taken from, read from the entries
+# only the approximate models have
+def stateKernelMode(state):
+    if any(key.startswith("variational_strategy.") for key in state):
+        return "SVGP"
+
+    if stateEntry(state, "inducing_points") is not None:
+        return "SGPR"
+
+    if stateEntry(state, "randn_weights") is not None:
+        return "RFF"
+
+    return "RBF"
+
+
+# RFF feature map matching gpytorch's RFFKernel, scaled so K = Phi Phi^T.
+# W is the (dims, F) frequency matrix already divided by the lengthscales
+def rffFeatureMap(X, W, outputscale):
+    XW = X @ W
+    return torch.cat([torch.cos(XW), torch.sin(XW)], dim=1) * torch.sqrt(
+        outputscale / W.shape[1]
+    )
+
+
+# squared euclidean distances between the rows of A and B
+def sqDist(A, B):
+    d = A.pow(2).sum(dim=1, keepdim=True) - 2 * A @ B.t() + B.pow(2).sum(dim=1)
+    return d.clamp_min(0)
+
+
+# one multi-start training run (see Snippet.optimizeRestarts). snippet is an untrained
+# copy with the filter set. Restarts other than the first one start from random
+# hyperparameters drawn with seed. Runs in a worker process or inline
+def fitRestart(snippet, X, y, state, steps, seed, learningRate, randomize):
+    if multiprocessing.parent_process() is not None:
+        torch.set_num_threads(1)
+
+    torch.manual_seed(seed)
+    snippet.learningRate = learningRate
+    snippet.gpr = snippet.createGPR(X, y, state)
+    if state is not None:
+        snippet.gpr.load_state_dict(state)
+    if randomize:
+        snippet.randomizeHyperparameters()
+
+    stopReason = snippet.optimize(X, y, steps)
+
+    return {
+        "state": snippet.gpr.state_dict(),
+        "losses": snippet.losses,
+        "stabilityStats": snippet.stabilityStats,
+        "stopReason": stopReason,
+        "learningRate": learningRate,
+        "seed": seed,
+    }
+
+
 # couple snippet notes
 # - Input vectors are assumed to already be normalized. They don't technically have to be for training,
 #   but the samplers will fail because they have a hard [0,1] clamp constraint.
 class Snippet:
     def __init__(self, name, paramInfo=None):
         self.name = name
-        self.data = []
         self.filter = []
         self.optSteps = 2000
         self.learningRate = 0.005
         self.lossTolerance = 1e-5
+        self.lossWindow = 10
+        self.lossPatience = 5
+
+        # numerical stability: a step that fails (covariance not positive definite) is
+        # retried up to jitterRetries times, multiplying the model jitter by jitterGrowth
+        # each time (up to maxJitter), and then once in float64. The raised jitter is kept
+        self.jitterRetries = 3
+        self.jitterGrowth = 10
+        self.maxJitter = 1e-1
+        self.stabilityStats = None
+
+        # exact RBF training can cache the per-dimension squared differences of the
+        # training inputs (N^2 * dims values) if they fit in distanceCacheBudget bytes.
+        # Off by default: on CPU it measured no faster than recomputing the distances
+        self.distanceCacheBudget = 0
+
+        # multi-start training: restarts runs from random hyperparameters (the first one
+        # uses the normal initialization), each with every rate in restartLearningRates
+        # (defaults to learningRate). Runs in up to restartWorkers processes, the run with
+        # the lowest final loss is kept
+        self.restarts = 1
+        self.restartLearningRates = None
+        self.restartWorkers = os.cpu_count()
+        self.restartSeed = None
+
+        # relevance pruning: after training, filtered params with an ARD lengthscale above
+        # pruneLengthscale hardly change the score (inputs are in [0, 1]). They are dropped
+        # from the filter (keeping at least pruneMinParams) and the rest is refit for up
+        # to pruneSteps steps from the trained hyperparameters. None turns pruning off
+        self.pruneLengthscale = None
+        self.pruneMinParams = 1
+        self.pruneSteps = 200
+
+        # "adam" or "lbfgs"
+        self.optimizer = "adam"
+
+        # "float32" trains and predicts in float32, "float64" does both in float64 and
+        # "mixed" trains in float64 and predicts (and compiles) in float32. The cached
+        # posterior is always factored in float64, then stored in the prediction type
+        self.precision = "float32"
+
+        # warm start: retraining with an unchanged filter starts from the last trained
+        # hyperparameters and only runs warmStartSteps, capped at warmStartFraction of optSteps
+        self.warmStart = False
+        self.warmStartSteps = 200
+        self.warmStartFraction = 0.25
+        self.trainedFilter = None
+        self.trainedMode = None
+
+        # ids of the examples the trained model holds, in the order of its training rows.
+        # updatePosterior compares these to dataIds to find added and removed examples
+        self.trainedIds = []
+
+        # training examples are stored column-wise: one row per example in dataX, scores
+        # in dataY, only the first dataCount rows are valid. Capacity doubles as needed.
+        # Kept in float64 so the float64 precision mode trains on the exact values
+        self.dataX = None
+        self.dataY = None
+        self.dataAffected = []
+        self.dataCount = 0
+        self.trainCache = None
+
+        # every example gets a unique id, they move with the example on removeData
+        self.dataIds = []
+        self.nextDataId = 0
+
         self.gpr = None
+
+        # "RBF" is the exact GP. "SGPR" and "SVGP" are inducing point approximations with
+        # inducingPoints points, SVGP trains on minibatches of batchSize examples.
+        # "RFF" approximates the kernel with rffFeatures random fourier features
         self.kernelMode = "RBF"
+        self.inducingPoints = 256
+        self.batchSize = 512
+        self.rffFeatures = 256
         self.kernel = {"variance": 1.0, "lengthscale": 1.0}
         self.dirtyKernel = False
         self.likelihood = gpytorch.likelihoods.GaussianLikelihood()
         self.paramInfo = paramInfo
+        self.linkIndex = None
+        self.defaultFilterCache = None
+
+        # incremented on every change to the training data, used to key cached results
+        self.dataVersion = 0
+
+        # incremented whenever the trained model changes (train, loadGPR). The posterior
+        # cache is keyed by this and the filter, so it is only rebuilt when the model's
+        # data or hyperparameters change
+        self.modelVersion = 0
+        self.posterior = None
+        self.posteriorHits = 0
+        self.posteriorMisses = 0
+
+        # opt-in LRU cache of predictions, keyed by the filtered vector rounded to
+        # memoTolerance. Holds at most memoSize entries, cleared when the model changes
+        self.memoize = False
+        self.memoTolerance = 1e-6
+        self.memoSize = 4096
+        self.memoCache = OrderedDict()
+        self.memoVersion = None
+        self.memoHits = 0
+        self.memoMisses = 0
+        self.memoLock = Lock()
+
+    # snippets are pickled for sampler worker processes. The lock, counters and lazily
+    # built caches stay behind, so the pickle only changes with the model or settings
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["memoCache"] = OrderedDict()
+        state["memoVersion"] = None
+        state["memoHits"] = 0
+        state["memoMisses"] = 0
+        state["posteriorHits"] = 0
+        state["posteriorMisses"] = 0
+        state["trainCache"] = None
+        state["linkIndex"] = None
+        state["defaultFilterCache"] = None
+        if self.posterior is not None:
+            state["posterior"] = {
+                k: v for k, v in self.posterior.items() if k != "compiled"
+            }
+        del state["memoLock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.memoLock = Lock()
 
     # param filter is a list of which parameter vector indices are to be used
     # for sampling and training
@@ -75,18 +420,124 @@ class Snippet:
             for i in range(0, len(data))
         ]
 
+    # training examples as Training objects. These are built on demand, prefer
+    # dataX / dataY (or getXTrain / getYTrain) internally
+    @property
+    def data(self):
+        return [
+            Training(self.dataX[i].tolist(), self.dataY[i].item(), self.dataAffected[i])
+            for i in range(0, self.dataCount)
+        ]
+
     def setData(self, items):
-        self.data = items
+        self.dataCount = len(items)
+        self.dataAffected = [list(i.affected) for i in items]
+        self.dataIds = list(range(self.nextDataId, self.nextDataId + self.dataCount))
+        self.nextDataId += self.dataCount
+
+        if self.dataCount > 0:
+            self.dataX = torch.tensor(
+                [[float(v) for v in i.data] for i in items], dtype=torch.float64
+            )
+            self.dataY = torch.tensor(
+                [float(i.score) for i in items], dtype=torch.float64
+            )
+        else:
+            self.dataX = None
+            self.dataY = None
+
+        self.dataVersion += 1
+
+    # grows the example arrays so that count rows fit. Capacity doubles, so a
+    # sequence of adds is amortized O(1) per example
+    def reserve(self, count, dims):
+        if self.dataX is None:
+            capacity = max(count, 8)
+            self.dataX = torch.zeros(capacity, dims, dtype=torch.float64)
+            self.dataY = torch.zeros(capacity, dtype=torch.float64)
+        elif count > self.dataX.shape[0]:
+            capacity = max(count, 2 * self.dataX.shape[0])
+            X = torch.zeros(capacity, dims, dtype=torch.float64)
+            y = torch.zeros(capacity, dtype=torch.float64)
+            X[0 : self.dataCount] = self.dataX[0 : self.dataCount]
+            y[0 : self.dataCount] = self.dataY[0 : self.dataCount]
+            self.dataX = X
+            self.dataY = y
 
     def addData(self, item):
-        self.data.append(item)
-
-    def addTraining(self, x, y):
-        self.data.append(Training(x, y))
+        self.addTraining(item.data, item.score, item.affected)
 
+    def addTraining(self, x, y, affected=[]):
+        self.reserve(self.dataCount + 1, len(x))
+        self.dataX[self.dataCount] = torch.tensor(
+            [float(v) for v in x], dtype=torch.float64
+        )
+        self.dataY[self.dataCount] = float(y)
+        self.dataAffected.append(list(affected))
+        self.dataIds.append(self.nextDataId)
+        self.nextDataId += 1
+        self.dataCount += 1
+        self.dataVersion += 1
+
+    # removes an example by moving the last example into its slot (O(1)).
+    # Note that this changes the index of the last example.
     def removeData(self, index):
-        if index < len(self.data):
-            del self.data[index]
+        if index < 0:
+            index = index + self.dataCount
+
+        if 0 <= index < self.dataCount:
+            last = self.dataCount - 1
+            if index != last:
+                self.dataX[index] = self.dataX[last]
+                self.dataY[index] = self.dataY[last]
+                self.dataAffected[index] = self.dataAffected[last]
+                self.dataIds[index] = self.dataIds[last]
+
+            self.dataAffected.pop()
+            self.dataIds.pop()
+            self.dataCount = last
+            self.dataVersion += 1
+
+    # returns a new snippet with the same examples and settings but no trained model
+    def clone(self, name=None):
+        s = Snippet(self.name if name is None else name, self.paramInfo)
+        if self.dataCount > 0:
+            s.dataX = self.dataX[0 : self.dataCount].clone()
+            s.dataY = self.dataY[0 : self.dataCount].clone()
+            s.dataAffected = [list(a) for a in self.dataAffected]
+            s.dataIds = list(self.dataIds)
+            s.dataCount = self.dataCount
+        s.nextDataId = self.nextDataId
+        s.optSteps = self.optSteps
+        s.learningRate = self.learningRate
+        s.lossTolerance = self.lossTolerance
+        s.lossWindow = self.lossWindow
+        s.lossPatience = self.lossPatience
+        s.jitterRetries = self.jitterRetries
+        s.jitterGrowth = self.jitterGrowth
+        s.maxJitter = self.maxJitter
+        s.distanceCacheBudget = self.distanceCacheBudget
+        s.optimizer = self.optimizer
+        s.precision = self.precision
+        s.restarts = self.restarts
+        s.restartLearningRates = self.restartLearningRates
+        s.restartWorkers = self.restartWorkers
+        s.restartSeed = self.restartSeed
+        s.pruneLengthscale = self.pruneLengthscale
+        s.pruneMinParams = self.pruneMinParams
+        s.pruneSteps = self.pruneSteps
+        s.kernelMode = self.kernelMode
+        s.inducingPoints = self.inducingPoints
+        s.batchSize = self.batchSize
+        s.rffFeatures = self.rffFeatures
+        s.warmStart = self.warmStart
+        s.warmStartSteps = self.warmStartSteps
+        s.warmStartFraction = self.warmStartFraction
+        s.memoize = self.memoize
+        s.memoTolerance = self.memoTolerance
+        s.memoSize = self.memoSize
+
+        return s
 
     def changeKernelMode(self, mode):
         self.kernelMode = mode
@@ -112,11 +563,55 @@ class Snippet:
 
         return state
 
-    # load data
+    # builds an untrained gpr of the current kernel mode on the filtered training data.
+    # If state is given, the approximation (inducing points, number of features) is
+    # sized to match it. Otherwise inducing points start from a random subset of X
+    def createGPR(self, X, y, state=None):
+        self.likelihood = gpytorch.likelihoods.GaussianLikelihood()
+
+        if self.kernelMode == "RFF":
+            features = self.rffFeatures
+            if state is not None:
+                features = stateEntry(state, "randn_weights").shape[-1]
+
+            gpr = RFFModel(X, y, self.likelihood, len(self.filter), features)
+        elif self.kernelMode in ["SGPR", "SVGP"]:
+            if state is not None:
+                inducing = stateEntry(state, "inducing_points")
+            else:
+                inducing = X[torch.randperm(len(X))[0 : self.inducingPoints]].clone()
+
+            if self.kernelMode == "SGPR":
+                gpr = SGPRModel(X, y, self.likelihood, len(self.filter), inducing)
+            else:
+                gpr = SVGPModel(self.likelihood, len(self.filter), inducing)
+        else:
+            gpr = ExactGPModel(X, y, self.likelihood, len(self.filter))
+
+        return gpr.to(self.trainDtype())
+
+    # torch dtypes for training and for predictions, set by precision
+    def trainDtype(self):
+        if self.precision in ["float64", "mixed"]:
+            return torch.float64
+
+        return torch.float32
+
+    def inferenceDtype(self):
+        if self.precision == "float64":
+            return torch.float64
+
+        return torch.float32
+
+    # load data. A filter saved with the state (see finishTrain) takes priority over filter
     def loadGPR(self, trainData, state, filter=None):
         # set the X and Y examples
         self.setData(trainData)
 
+        if "filter" in state:
+            filter = list(state["filter"])
+            state = {key: state[key] for key in state if key != "filter"}
+
         # construct GPR
         # note: user should re-set filter manually after this completes (for now)
         if filter is None:
@@ -124,32 +619,50 @@ class Snippet:
         else:
             self.setParamFilter(filter)
 
-        self.likelihood = gpytorch.likelihoods.GaussianLikelihood()
-        self.gpr = ExactGPModel(
-            self.getXTrain(), self.getYTrain(), self.likelihood, len(self.filter)
+        # load kernel settings. The model type is recognized from the state, so the
+        # snippet doesn't need the kernel mode set first
+        state = self.torchStateDict(state)
+        self.kernelMode = stateKernelMode(state)
+        dtype = self.trainDtype()
+        self.gpr = self.createGPR(
+            self.getXTrain().to(dtype), self.getYTrain().to(dtype), state
         )
 
-        # load kernel settings
-        self.gpr.load_state_dict(self.torchStateDict(state))
+        # states saved before the jitter was part of the model use the default
+        if "jitter" not in state:
+            state["jitter"] = self.gpr.jitter
 
-    def getXTrain(self):
-        # returns training data vector. Row-wise (?)
-        X = []
-        for t in self.data:
-            v = t.data
-            X.append([float(v[idx]) for idx in self.filter])
+        self.gpr.load_state_dict(state)
+        self.trainedFilter = list(self.filter)
+        self.trainedMode = self.kernelMode
+        self.trainedIds = list(self.dataIds)
+        self.modelChanged()
 
-        return torch.tensor(X)
+    # returns the (filtered X, y) training tensors. These are gathered once per data
+    # version and filter, so repeated calls don't copy. They are never views into the
+    # example arrays, removeData writes to those in place.
+    def getTrainTensors(self):
+        key = (self.dataVersion, tuple(self.filter))
+        if self.trainCache is None or self.trainCache["key"] != key:
+            X = self.dataX[0 : self.dataCount][:, self.filter]
+            y = self.dataY[0 : self.dataCount].clone()
+            self.trainCache = {"key": key, "X": X, "y": y}
 
-    def getYTrain(self):
-        y = [float(i.score) for i in self.data]
+        return self.trainCache["X"], self.trainCache["y"]
 
-        return torch.tensor(y)
+    def getXTrain(self):
+        # returns training data vector. Row-wise
+        return self.getTrainTensors()[0]
+
+    def getYTrain(self):
+        return self.getTrainTensors()[1]
 
     # runs GPR based on current data set
-    def train(self, optCB=None, customFilter=None):
+    # warmStart (defaults to the snippet setting) reuses the current hyperparameters
+    # as the starting point if the filter hasn't changed since the last train
+    def train(self, optCB=None, customFilter=None, warmStart=None):
         # check that training data exists
-        if len(self.data) == 0:
+        if self.dataCount == 0:
             return DSStatus(
                 code=-1,
                 message="Snippet training failure. No training data set for Snippet {0}".format(
@@ -157,6 +670,179 @@ class Snippet:
                 ),
             )
 
+        X, y, prevState = self.prepareTrain(customFilter, warmStart)
+
+        steps = self.optSteps
+        if prevState is not None:
+            steps = self.warmStartStepCount()
+            logger.info("Snippet {0} warm start, {1} steps".format(self.name, steps))
+
+        multiStart = self.restarts > 1 or bool(self.restartLearningRates)
+        if multiStart:
+            stopReason, restarts, best = self.optimizeRestarts(X, y, steps, prevState)
+        else:
+            stopReason = self.optimize(X, y, steps, optCB)
+
+        retData = self.finishTrain(prevState is not None, stopReason)
+
+        if multiStart:
+            retData["restarts"] = restarts
+            retData["bestRestart"] = best
+
+        return self.pruneParams(retData)
+
+    # ARD lengthscales of the trained model, one per filtered param (in filter order)
+    def getLengthscale(self):
+        for module in self.gpr.modules():
+            if isinstance(module, gpytorch.kernels.Kernel) and module.has_lengthscale:
+                return module.lengthscale.detach().view(-1)
+
+        return None
+
+    # relevance pruning (see pruneLengthscale), run on the retData of a finished training
+    # run. Adds the pruned params to retData, and if any were pruned the refit: the new
+    # filter, state and jitter, and the refit losses (pruneLosses) and stop reason
+    def pruneParams(self, retData):
+        if self.pruneLengthscale is None:
+            return retData
+
+        lengthscale = self.getLengthscale()
+        keep = (lengthscale <= self.pruneLengthscale).nonzero().view(-1).tolist()
+        if len(keep) < self.pruneMinParams:
+            keep = sorted(lengthscale.argsort()[0 : self.pruneMinParams].tolist())
+
+        pruned = [self.filter[i] for i in range(len(self.filter)) if i not in keep]
+        retData["pruned"] = pruned
+
+        if len(pruned) == 0:
+            return retData
+
+        logger.info(
+            "Snippet {0} pruned {1} params: {2}".format(self.name, len(pruned), pruned)
+        )
+
+        state = pruneState(self.gpr.state_dict(), keep)
+        self.setParamFilter([self.filter[i] for i in keep])
+        X = self.getXTrain().to(self.trainDtype())
+        y = self.getYTrain().to(self.trainDtype())
+        self.gpr = self.createGPR(X, y, state)
+        self.gpr.load_state_dict(state)
+        self.trainedFilter = list(self.filter)
+
+        losses = self.losses
+        stopReason = self.optimize(X, y, self.pruneSteps)
+        refit = self.finishTrain(True, stopReason)
+        self.losses = losses + self.losses
+
+        retData["filter"] = refit["filter"]
+        retData["state"] = refit["state"]
+        retData["jitter"] = refit["jitter"]
+        retData["jitterEscalations"] = refit["jitterEscalations"]
+        retData["float64Steps"] = refit["float64Steps"]
+        retData["pruneLosses"] = refit["losses"]
+        retData["pruneStopReason"] = stopReason
+
+        return retData
+
+    # optimizer steps of a warm start, always fewer than a cold start
+    def warmStartStepCount(self):
+        return max(
+            1, min(self.warmStartSteps, int(self.optSteps * self.warmStartFraction))
+        )
+
+    # draws random starting hyperparameters: log-uniform lengthscales in [0.05, 5],
+    # outputscale in [0.1, 10] and noise in [1e-3, 1]
+    def randomizeHyperparameters(self):
+        def logUniform(lo, hi, shape):
+            return torch.exp(
+                math.log(lo) + torch.rand(shape) * (math.log(hi) - math.log(lo))
+            )
+
+        for module in self.gpr.modules():
+            if isinstance(module, gpytorch.kernels.ScaleKernel):
+                module.outputscale = logUniform(0.1, 10, module.outputscale.shape)
+            elif getattr(module, "has_lengthscale", False):
+                module.lengthscale = logUniform(0.05, 5, module.lengthscale.shape)
+
+        self.likelihood.noise = logUniform(1e-3, 1, self.likelihood.noise.shape)
+
+    # multi-start training, every restart / learning rate pair is one fitRestart run.
+    # Loads the best run (lowest final loss, runs that errored only if nothing else
+    # finished) into the gpr. Returns its stop reason, a summary of every run and the
+    # index of the best one
+    def optimizeRestarts(self, X, y, steps, prevState=None):
+        rates = self.restartLearningRates or [self.learningRate]
+        seeds = np.random.SeedSequence(self.restartSeed)
+        restartSeeds = [
+            int(seq.generate_state(1)[0]) for seq in seeds.spawn(self.restarts)
+        ]
+        jobs = [
+            (restartSeeds[i], rate, i > 0)
+            for i in range(self.restarts)
+            for rate in rates
+        ]
+
+        logger.info(
+            "Snippet {0} multi-start training: {1} runs, seed {2}".format(
+                self.name, len(jobs), seeds.entropy
+            )
+        )
+
+        base = self.clone()
+        base.filter = list(self.filter)
+        base.restarts = 1
+        state = None if prevState is None else self.gpr.state_dict()
+        workers = max(1, min(len(jobs), int(self.restartWorkers or 1)))
+
+        # runs go through the worker pool shared with the samplers, so workers (and their
+        # torch import) are reused across retrains. At most workers runs are queued at once
+        if workers > 1:
+            pool = getWorkerPool()
+            runs = [None] * len(jobs)
+            inflight = deque()
+            for i, job in enumerate(jobs):
+                if len(inflight) >= workers:
+                    j, future = inflight.popleft()
+                    runs[j] = future.result()
+
+                inflight.append(
+                    (i, pool.submit(fitRestart, base, X, y, state, steps, *job))
+                )
+
+            for j, future in inflight:
+                runs[j] = future.result()
+        else:
+            runs = [fitRestart(base, X, y, state, steps, *job) for job in jobs]
+
+        def rank(i):
+            run = runs[i]
+            if len(run["losses"]) == 0:
+                return (2, 0)
+
+            return (1 if run["stopReason"] == "error" else 0, run["losses"][-1])
+
+        best = min(range(len(runs)), key=rank)
+
+        self.gpr.load_state_dict(runs[best]["state"])
+        self.losses = runs[best]["losses"]
+        self.stabilityStats = runs[best]["stabilityStats"]
+
+        summary = [
+            {
+                "losses": run["losses"],
+                "stopReason": run["stopReason"],
+                "learningRate": run["learningRate"],
+                "seed": run["seed"],
+            }
+            for run in runs
+        ]
+
+        return runs[best]["stopReason"], summary, best
+
+    # sets the filter and builds an untrained gpr for it, starting from the previous
+    # hyperparameters when warm starting. Returns the training tensors and the previous
+    # state (None for a cold start)
+    def prepareTrain(self, customFilter=None, warmStart=None):
         # In the event that additional data points have extended the relevant dimensions,
         # adjust the filter.
         # TODO: allow custom overrides for the filter
@@ -165,66 +851,213 @@ class Snippet:
         else:
             self.setDefaultFilter()
 
+        self.stabilityStats = {"jitterEscalations": 0, "float64Steps": 0}
+
         # generate X matrix
-        X = self.getXTrain()
+        X = self.getXTrain().to(self.trainDtype())
 
         # generate y vector
-        y = self.getYTrain()
-
-        # TODO: allow gpr settings per-snippet?
-        # self.gpr = gp.models.GPRegression(X, y, kernel)
-        self.likelihood = gpytorch.likelihoods.GaussianLikelihood()
-        self.gpr = ExactGPModel(X, y, self.likelihood, len(self.filter))
-
-        self.gpr.train()
-        self.likelihood.train()
-
-        # hyperparams
-        optimizer = torch.optim.Adam(
-            [{"params": self.gpr.parameters()}], lr=self.learningRate
-        )
-        mll = gpytorch.mlls.ExactMarginalLogLikelihood(self.likelihood, self.gpr)
-        self.losses = []
-        for i in range(self.optSteps):
-            try:
-                optimizer.zero_grad()
-                output = self.gpr(X)
-                loss = -mll(output, y)
-                loss.backward()
-                # print(
-                #     "Iter %d/%d - Loss: %.3f   lengthscale: %.3f   noise: %.3f"
-                #     % (
-                #         i + 1,
-                #         self.optSteps,
-                #         loss.item(),
-                #         self.gpr.covar_module.base_kernel.lengthscale.item(),
-                #         self.gpr.likelihood.noise.item(),
-                #     )
-                # )
-
-                if optCB:
-                    optCB(loss.item())
-
-                self.losses.append(loss.item())
-                optimizer.step()
-            except:
-                # early abort, likely a cholesky problem
-                # todo: ask matt why cholesky might fail in the above mll function
-                logger.warning("Early abort: {0}".format(sys.exc_info()[0]))
-                break
+        y = self.getYTrain().to(self.trainDtype())
+
+        if warmStart is None:
+            warmStart = self.warmStart
+
+        # previous hyperparameters are only valid for the same set of dimensions,
+        # otherwise fall back to a cold start
+        prevState = None
+        if (
+            warmStart
+            and self.gpr is not None
+            and self.trainedFilter == self.filter
+            and self.trainedMode == self.kernelMode
+        ):
+            prevState = self.gpr.state_dict()
+
+        # warm starts keep the previous approximation, so all shapes match
+        self.gpr = self.createGPR(X, y, prevState)
+        self.trainedFilter = list(self.filter)
+        self.trainedMode = self.kernelMode
+        self.trainedIds = list(self.dataIds)
+
+        if prevState is not None:
+            self.gpr.load_state_dict(prevState)
+
+        return X, y, prevState
+
+    # wraps up a training run (self.losses holds the loss curve) and returns its retData
+    def finishTrain(self, warmStarted, stopReason):
+        # parameter gradients aren't needed after training, don't keep them alive
+        self.gpr.zero_grad(set_to_none=True)
+        self.modelChanged()
 
         # debug
         # plt.plot(losses)
         retData = {}
         retData["state"] = self.unTorchStateDict()
+        # the filter is saved with the state, relevance pruning can leave the model with
+        # fewer params than the default filter
+        retData["state"]["filter"] = list(self.trainedFilter)
+        retData["filter"] = list(self.trainedFilter)
         retData["type"] = self.kernelMode
         retData["code"] = 0
         retData["losses"] = self.losses
+        retData["warmStart"] = warmStarted
+        retData["stopReason"] = stopReason
+        retData["iterations"] = len(self.losses)
+        retData["jitter"] = self.gpr.jitter.item()
+        retData["jitterEscalations"] = self.stabilityStats["jitterEscalations"]
+        retData["float64Steps"] = self.stabilityStats["float64Steps"]
         retData["message"] = "Snippet {0} training complete".format(self.name)
         retData["defaultFilter"] = self.getDefaultFilter()
 
         return retData
 
+    # runs the hyperparameter optimizer on the current gpr for at most steps iterations,
+    # with the distance cache of the exact RBF kernel set up for the duration
+    def optimize(self, X, y, steps, optCB=None):
+        cachedKernels = [
+            module
+            for module in self.gpr.modules()
+            if isinstance(module, CachedRBFKernel)
+        ]
+        for kernel in cachedKernels:
+            kernel.setCache(X, self.distanceCacheBudget)
+
+        try:
+            return self.runOptimizer(X, y, steps, optCB)
+        finally:
+            for kernel in cachedKernels:
+                kernel.clearCache()
+
+    # Stops early once the relative loss change over lossWindow iterations has stayed
+    # below lossTolerance for lossPatience iterations. Returns why the loop stopped.
+    def runOptimizer(self, X, y, steps, optCB=None):
+        self.gpr.train()
+        self.likelihood.train()
+
+        # hyperparams
+        if self.optimizer == "lbfgs":
+            # one L-BFGS iteration per step. max_eval bounds the line search, its default
+            # is derived from max_iter and would leave no evaluations for the search
+            optimizer = torch.optim.LBFGS(
+                self.gpr.parameters(),
+                lr=1,
+                max_iter=1,
+                max_eval=25,
+                line_search_fn="strong_wolfe",
+            )
+        else:
+            optimizer = torch.optim.Adam(
+                [{"params": self.gpr.parameters()}], lr=self.learningRate
+            )
+
+        # SVGP maximizes the ELBO, one minibatch per step (all steps of the line search
+        # use the same batch)
+        batch = None
+        minibatch = self.kernelMode == "SVGP" and len(y) > self.batchSize
+
+        def objective(model):
+            if self.kernelMode == "SVGP":
+                return gpytorch.mlls.VariationalELBO(model.likelihood, model, len(y))
+
+            return gpytorch.mlls.ExactMarginalLogLikelihood(model.likelihood, model)
+
+        mll = objective(self.gpr)
+
+        def closure():
+            optimizer.zero_grad()
+            if batch is None:
+                loss = -mll(self.gpr(X), y)
+            else:
+                loss = -mll(self.gpr(X[batch]), y[batch])
+            loss.backward()
+            return loss
+
+        # same as closure, evaluated on a float64 copy of the model. The gradients are
+        # copied back to the parameters so the optimizer state is unchanged
+        def closure64():
+            optimizer.zero_grad()
+            model = copy.deepcopy(self.gpr).double()
+            X64 = X.double() if batch is None else X[batch].double()
+            y64 = y.double() if batch is None else y[batch].double()
+            if isinstance(model, gpytorch.models.ExactGP):
+                model.set_train_data(X64, y64, strict=False)
+
+            loss = -objective(model)(model(X64), y64)
+            loss.backward()
+
+            for param, param64 in zip(self.gpr.parameters(), model.parameters()):
+                if param64.grad is not None:
+                    param.grad = param64.grad.to(param.dtype)
+
+            return loss.detach().to(torch.get_default_dtype())
+
+        def step(f):
+            if self.optimizer == "lbfgs":
+                return optimizer.step(f)
+
+            loss = f()
+            optimizer.step()
+            return loss
+
+        self.stabilityStats = {"jitterEscalations": 0, "float64Steps": 0}
+        self.losses = []
+        stalled = 0
+        for i in range(steps):
+            if minibatch:
+                batch = torch.randperm(len(y))[0 : self.batchSize]
+
+            loss = None
+            retries = 0
+            while loss is None:
+                try:
+                    loss = step(closure)
+                except Exception:
+                    # likely a cholesky problem, raise the jitter and retry the step
+                    logger.info(
+                        "Snippet {0} step {1} failed: {2}".format(
+                            self.name, i, sys.exc_info()[0]
+                        )
+                    )
+                    jitter = self.gpr.jitter.item() * self.jitterGrowth
+                    if retries >= self.jitterRetries or jitter > self.maxJitter:
+                        break
+
+                    with torch.no_grad():
+                        self.gpr.jitter.fill_(jitter)
+                    self.stabilityStats["jitterEscalations"] += 1
+                    retries += 1
+
+            if loss is None:
+                try:
+                    loss = step(closure64)
+                    self.stabilityStats["float64Steps"] += 1
+                except Exception:
+                    pass
+
+            if loss is None:
+                logger.warning(
+                    "Early abort: step {0} failed at jitter {1}".format(
+                        i, self.gpr.jitter.item()
+                    )
+                )
+                return "error"
+
+            if optCB:
+                optCB(loss.item())
+
+            self.losses.append(loss.item())
+
+            if len(self.losses) > self.lossWindow:
+                prev = self.losses[-1 - self.lossWindow]
+                change = abs(prev - self.losses[-1]) / max(abs(prev), 1e-12)
+                stalled = stalled + 1 if change < self.lossTolerance else 0
+
+                if stalled >= self.lossPatience:
+                    return "converged"
+
+        return "maxSteps"
+
     def plotLastLoss(self):
         graphUtils.plotLoss(self.losses)
 
@@ -232,88 +1065,654 @@ class Snippet:
         graphUtils.plot1DPredictions(x, self, paramIdx=dim, rmin=rmin, rmax=rmax, n=n)
 
     def predict(self, items):
+        # need to filter the input based on the current filter val
+        # tensor input (one row per item) can be indexed directly
+        if torch.is_tensor(items):
+            Xtest = items[:, self.filter]
+        else:
+            Xtest = torch.tensor(self.applyFilter(items), dtype=self.inferenceDtype())
+
+        if self.memoize:
+            return self.predictMemo(Xtest)
+
+        with torch.no_grad():
+            return self.predictFiltered(Xtest)
+
+    # memoized predictFiltered. Rows are keyed by the filtered vector rounded to
+    # memoTolerance, and only the misses go through the model (in one call)
+    def predictMemo(self, Xtest):
+        Q = torch.round(Xtest.double() / self.memoTolerance).long().numpy()
+        keys = [row.tobytes() for row in Q]
+        mean = torch.empty(len(keys), dtype=self.inferenceDtype())
+        cov = torch.empty(len(keys), dtype=self.inferenceDtype())
+        missing = []
+
+        with self.memoLock:
+            version = (self.modelVersion, tuple(self.filter))
+            if self.memoVersion != version:
+                self.memoCache.clear()
+                self.memoVersion = version
+
+            for i, key in enumerate(keys):
+                val = self.memoCache.get(key)
+                if val is None:
+                    missing.append(i)
+                else:
+                    self.memoCache.move_to_end(key)
+                    mean[i], cov[i] = val
+
+            self.memoHits += len(keys) - len(missing)
+            self.memoMisses += len(missing)
+
+        if len(missing) > 0:
+            with torch.no_grad():
+                res = self.predictFiltered(Xtest[missing])
+            mean[missing] = res["mean"]
+            cov[missing] = res["cov"]
+
+            with self.memoLock:
+                # the model may have changed while predicting, don't store stale values
+                if self.memoVersion == version:
+                    for i, m, c in zip(
+                        missing, res["mean"].tolist(), res["cov"].tolist()
+                    ):
+                        self.memoCache[keys[i]] = (m, c)
+
+                    while len(self.memoCache) > self.memoSize:
+                        self.memoCache.popitem(last=False)
+
+        return {"mean": mean, "cov": cov}
+
+    def memoStats(self):
+        lookups = self.memoHits + self.memoMisses
+        return {
+            "hits": self.memoHits,
+            "misses": self.memoMisses,
+            "hitRate": self.memoHits / lookups if lookups > 0 else 0,
+            "size": len(self.memoCache),
+        }
+
+    # differentiable version of predict. X is a (n, params) tensor, and gradients
+    # flow back to X through the returned mean and variance
+    def predictTensor(self, X):
+        return self.predictFiltered(X[:, self.filter])
+
+    # predicts already filtered inputs. The RBF model uses the cached posterior:
+    # one cross-covariance and two matrix products. The RFF model uses its weight space
+    # posterior: a feature map and two matrix products, independent of N
+    def predictFiltered(self, Xtest):
+        if self.trainedMode == "RBF":
+            post = self.getPosterior()
+            Xtest = Xtest.to(post["Z"].dtype)
+            Kxs = post["outputscale"] * torch.exp(
+                -0.5 * sqDist(Xtest / post["lengthscale"], post["Z"])
+            )
+            mean = post["constant"] + Kxs @ post["alpha"]
+            cov = (
+                post["outputscale"]
+                + post["jitter"]
+                + post["noise"]
+                - (Kxs @ post["varianceCache"]).pow(2).sum(dim=1)
+            )
+
+            return {"mean": mean, "cov": cov}
+
+        if self.trainedMode == "RFF":
+            post = self.getPosterior()
+            Xtest = Xtest.to(post["W"].dtype)
+            Phi = rffFeatureMap(Xtest, post["W"], post["outputscale"])
+            mean = post["constant"] + Phi @ post["weights"]
+            cov = (
+                post["jitter"]
+                + post["noise"]
+                + (Phi @ post["varianceCache"]).pow(2).sum(dim=1)
+            )
+
+            return {"mean": mean, "cov": cov}
+
         self.gpr.eval()
         self.likelihood.eval()
 
-        # need to filter the input based on the current filter val
-        Xtest = torch.tensor(self.applyFilter(items))
-        with torch.no_grad(), gpytorch.settings.fast_pred_var():
-            observed_pred = self.likelihood(self.gpr(Xtest))
+        with gpytorch.settings.fast_pred_var():
+            observed_pred = self.likelihood(self.gpr(Xtest.to(self.trainDtype())))
+
+        return {
+            "mean": observed_pred.mean.to(self.inferenceDtype()),
+            "cov": observed_pred.variance.to(self.inferenceDtype()),
+        }
+
+    # call after anything that changes the trained model
+    def modelChanged(self):
+        self.modelVersion += 1
+        self.posterior = None
+
+        with self.memoLock:
+            self.memoCache.clear()
+
+        # build the posterior now so the first predict doesn't pay for it
+        if self.trainedMode in ["RBF", "RFF"]:
+            self.getPosterior()
+
+    # returns the cached posterior factors, rebuilding them if the model or filter changed
+    def getPosterior(self):
+        key = (self.modelVersion, tuple(self.filter), self.precision)
+        if self.posterior is not None and self.posterior["key"] == key:
+            self.posteriorHits += 1
+            return self.posterior
+
+        self.posteriorMisses += 1
+        self.setPosterior(self.computePosterior(), key)
+
+        return self.posterior
 
-        return {"mean": observed_pred.mean, "cov": observed_pred.variance}
+    # stores float64 posterior factors in the prediction type. The float64 factors
+    # are kept as well, updatePosterior works from them
+    def setPosterior(self, factors, key):
+        dtype = self.inferenceDtype()
+        self.posterior = {
+            k: v.to(dtype) if torch.is_tensor(v) else v for k, v in factors.items()
+        }
+        self.posterior["key"] = key
+        self.posterior["factors"] = factors
+
+    def posteriorStats(self):
+        return {
+            "hits": self.posteriorHits,
+            "misses": self.posteriorMisses,
+            "modelVersion": self.modelVersion,
+            "memo": self.memoStats(),
+        }
 
     def predictOne(self, item):
         # identical to predict, but returns scalars
         res = self.predict([item])
         return {"mean": res["mean"].item(), "cov": res["cov"].item()}
 
+    # exact posterior factors of the trained RBF model, computed in float64:
+    #   L = chol(K + (jitter + noise) I), alpha = (K + (jitter + noise) I)^-1 (y - c)
+    # with K the ARD RBF kernel over the training inputs. The variance cache is V = L^-T,
+    # so the predictive variance is k** - |k*^T V|^2. Only V V^T = (K + (jitter + noise) I)^-1
+    # matters, updatePosterior keeps that but not the triangular shape
+    def computePosterior(self):
+        if self.trainedMode == "RFF":
+            return self.computeWeightPosterior()
+
+        with torch.no_grad():
+            kernel = self.gpr.covar_module
+            X = self.gpr.train_inputs[0].double()
+            y = self.gpr.train_targets.double()
+            lengthscale = kernel.base_kernel.lengthscale.double().view(-1)
+            outputscale = kernel.outputscale.double()
+            noise = self.likelihood.noise.double()
+            constant = self.gpr.mean_module.constant.detach().double()
+
+            Z = X / lengthscale
+            K = outputscale * torch.exp(-0.5 * sqDist(Z, Z))
+            K = K + (self.gpr.jitter.item() + noise) * torch.eye(
+                len(X), dtype=torch.double
+            )
+            L = torch.linalg.cholesky(K)
+            alpha = torch.cholesky_solve((y - constant).unsqueeze(-1), L).squeeze(-1)
+            varianceCache = torch.linalg.solve_triangular(
+                L, torch.eye(len(X), dtype=torch.double), upper=False
+            ).t()
+
+        return {
+            "X": X,
+            "y": y,
+            "Z": Z,
+            "alpha": alpha,
+            "varianceCache": varianceCache,
+            "lengthscale": lengthscale,
+            "outputscale": outputscale,
+            "noise": noise,
+            "constant": constant,
+            "jitter": self.gpr.jitter.item(),
+        }
+
+    # weight space posterior of the trained RFF model, in float64. With Phi the (N, 2F)
+    # training features and s2 = jitter + noise:
+    #   A = Phi^T Phi + s2 I = L L^T, weights = A^-1 Phi^T (y - c)
+    # The variance cache is sqrt(s2) L^-T: the predictive variance is |phi^T V|^2 + s2,
+    # and weights + V z with z ~ N(0, I) is a posterior function draw
+    def computeWeightPosterior(self):
+        with torch.no_grad():
+            kernel = self.gpr.covar_module
+            X = self.gpr.train_inputs[0].double()
+            y = self.gpr.train_targets.double()
+            lengthscale = kernel.base_kernel.lengthscale.double().view(-1)
+            W = kernel.base_kernel.randn_weights.double() / lengthscale.view(-1, 1)
+            outputscale = kernel.outputscale.double()
+            noise = self.likelihood.noise.double()
+            constant = self.gpr.mean_module.constant.detach().double()
+            s2 = self.gpr.jitter.item() + noise
+
+            Phi = rffFeatureMap(X, W, outputscale)
+            A = Phi.t() @ Phi + s2 * torch.eye(Phi.shape[1], dtype=torch.double)
+            L = torch.linalg.cholesky(A)
+            weights = torch.cholesky_solve(
+                (Phi.t() @ (y - constant)).unsqueeze(-1), L
+            ).squeeze(-1)
+            varianceCache = torch.sqrt(s2) * (
+                torch.linalg.solve_triangular(
+                    L, torch.eye(Phi.shape[1], dtype=torch.double), upper=False
+                ).t()
+            )
+
+        return {
+            "W": W,
+            "weights": weights,
+            "varianceCache": varianceCache,
+            "lengthscale": lengthscale,
+            "outputscale": outputscale,
+            "noise": noise,
+            "constant": constant,
+            "jitter": self.gpr.jitter.item(),
+        }
+
+    # brings the trained model up to date with the examples added or removed since it was
+    # trained, keeping the hyperparameters (train refits them). The exact RBF model
+    # updates its float64 factors in O(N^2) per example, other modes rebuild their
+    # posterior from the new data. SVGP can't be updated without training.
+    # Returns a summary, or None if there is no model that can be updated
+    def updatePosterior(self):
+        if (
+            self.gpr is None
+            or self.trainedFilter != self.filter
+            or self.trainedMode == "SVGP"
+        ):
+            logger.warning(
+                "Snippet {0} posterior can't be updated, train the snippet".format(
+                    self.name
+                )
+            )
+            return None
+
+        current = set(self.dataIds)
+        trained = set(self.trainedIds)
+        removed = [r for r, i in enumerate(self.trainedIds) if i not in current]
+        added = [k for k, i in enumerate(self.dataIds) if i not in trained]
+        summary = {"added": len(added), "removed": len(removed), "rebuilt": False}
+
+        if len(added) == 0 and len(removed) == 0:
+            return summary
+
+        factors = None
+        if self.trainedMode == "RBF":
+            try:
+                factors = self.updateFactors(
+                    self.getPosterior()["factors"], removed, added
+                )
+            except RuntimeError:
+                logger.warning(
+                    "Snippet {0} posterior update failed: {1}, rebuilding".format(
+                        self.name, sys.exc_info()[1]
+                    )
+                )
+
+        dtype = self.trainDtype()
+        if factors is None:
+            X, y = self.getTrainTensors()
+            self.gpr.set_train_data(X.to(dtype), y.to(dtype), strict=False)
+            self.trainedIds = list(self.dataIds)
+            self.modelChanged()
+            summary["rebuilt"] = True
+            return summary
+
+        self.gpr.set_train_data(
+            factors["X"].to(dtype), factors["y"].to(dtype), strict=False
+        )
+        self.trainedIds = [i for i in self.trainedIds if i in current] + [
+            self.dataIds[k] for k in added
+        ]
+
+        # same as modelChanged, but the new posterior is already known
+        self.modelVersion += 1
+        with self.memoLock:
+            self.memoCache.clear()
+        self.setPosterior(
+            factors, (self.modelVersion, tuple(self.filter), self.precision)
+        )
+
+        return summary
+
+    # removes the training rows in removed and appends the examples at data indices
+    # added to exact RBF posterior factors. With V V^T = A^-1 (A the noisy kernel matrix):
+    #   remove row r: A^-1 without r is V_r (I - u u^T) V_r^T, V_r is V without row r and
+    #     u is row r of V normalized. A householder reflection H with H u = e_N turns this
+    #     into V_r H with the last column dropped
+    #   append B = k(X, Xn), C = k(Xn, Xn) + s2 I: with P = V^T B and S = C - P^T P = Ls Ls^T
+    #     the new factor is [[V, -V P Ls^-T], [0, Ls^-T]]. With V = L^-T this is the usual
+    #     cholesky extension
+    # alpha is V V^T (y - c). Raises a RuntimeError if S isn't positive definite
+    def updateFactors(self, factors, removed, added):
+        X = factors["X"]
+        y = factors["y"]
+        V = factors["varianceCache"]
+        lengthscale = factors["lengthscale"]
+        outputscale = factors["outputscale"]
+        s2 = factors["jitter"] + factors["noise"]
+
+        with torch.no_grad():
+            for r in sorted(removed, reverse=True):
+                keep = [i for i in range(len(X)) if i != r]
+                u = V[r] / V[r].norm()
+                w = u.clone()
+                w[-1] -= 1
+                Vr = V[keep]
+                if w.norm() > 1e-12:
+                    Vr = Vr - (2 / w.dot(w)) * (Vr @ w).unsqueeze(1) * w
+                V = Vr[:, 0:-1]
+                X = X[keep]
+                y = y[keep]
+
+            if len(added) > 0:
+                idx = torch.tensor(added, dtype=torch.long)
+                Xn = self.dataX[idx][:, self.filter].double()
+                yn = self.dataY[idx].double()
+                Zn = Xn / lengthscale
+                C = outputscale * torch.exp(-0.5 * sqDist(Zn, Zn)) + s2 * torch.eye(
+                    len(added), dtype=torch.double
+                )
+
+                if len(X) > 0:
+                    B = outputscale * torch.exp(-0.5 * sqDist(X / lengthscale, Zn))
+                    P = V.t() @ B
+                    C = C - P.t() @ P
+
+                LsInvT = torch.linalg.solve_triangular(
+                    torch.linalg.cholesky(C),
+                    torch.eye(len(added), dtype=torch.double),
+                    upper=False,
+                ).t()
+
+                top = V
+                if len(X) > 0:
+                    top = torch.cat([V, -(V @ P) @ LsInvT], dim=1)
+                bottom = torch.cat(
+                    [torch.zeros(len(added), len(X), dtype=torch.double), LsInvT], dim=1
+                )
+                V = torch.cat([top, bottom], dim=0)
+                X = torch.cat([X, Xn], dim=0)
+                y = torch.cat([y, yn], dim=0)
+
+            alpha = V @ (V.t() @ (y - factors["constant"]))
+
+        updated = dict(factors)
+        updated["X"] = X
+        updated["y"] = y
+        updated["Z"] = X / lengthscale
+        updated["alpha"] = alpha
+        updated["varianceCache"] = V
+
+        return updated
+
+    # draws count functions from the posterior of the RBF or RFF model (None otherwise).
+    # Returns f mapping a (n, params) tensor to the (n, count) values of every draw.
+    # RFF draws are weight space samples. RBF draws use pathwise conditioning on an RFF
+    # prior draw f0 with rffFeatures features and s2 = jitter + noise:
+    #   f(x) = c + f0(x) + k(x, X) (K + s2 I)^-1 (y - c - f0(X) - e),  e ~ N(0, s2 I)
+    def posteriorDraws(self, count):
+        if self.trainedMode not in ["RBF", "RFF"]:
+            return None
+
+        post = self.getPosterior()
+        filterIdx = torch.tensor(self.filter, dtype=torch.long)
+        dtype = self.inferenceDtype()
+
+        with torch.no_grad():
+            if self.trainedMode == "RFF":
+                W = post["W"]
+                w = post["weights"].unsqueeze(1) + post["varianceCache"] @ torch.randn(
+                    len(post["weights"]), count, dtype=dtype
+                )
+                v = None
+            else:
+                lengthscale = post["lengthscale"]
+                W = torch.randn(
+                    len(lengthscale), self.rffFeatures, dtype=dtype
+                ) / lengthscale.view(-1, 1)
+                w = torch.randn(2 * self.rffFeatures, count, dtype=dtype)
+
+                s2 = post["jitter"] + post["noise"]
+                f0 = rffFeatureMap(post["X"], W, post["outputscale"]) @ w
+                e = torch.randn(len(post["X"]), count, dtype=dtype) * s2.sqrt()
+                r = post["y"].unsqueeze(1) - post["constant"] - f0 - e
+                V = post["varianceCache"]
+                v = V @ (V.t() @ r)
+
+        def f(Xtest):
+            with torch.no_grad():
+                X = Xtest[:, filterIdx].to(dtype)
+                res = post["constant"] + rffFeatureMap(X, W, post["outputscale"]) @ w
+                if v is not None:
+                    Kxs = post["outputscale"] * torch.exp(
+                        -0.5 * sqDist(X / post["lengthscale"], post["Z"])
+                    )
+                    res = res + Kxs @ v
+
+            return res
+
+        return f
+
+    # numpy-only predictor for an exact RBF model (see inference.CompiledSnippet), cached
+    # per model and filter. Other trained modes return the snippet itself
+    def compile(self):
+        if self.trainedMode != "RBF":
+            logger.warning(
+                "Snippet {0} kernel mode {1} can't be compiled, using full model".format(
+                    self.name, self.trainedMode
+                )
+            )
+            return self
+
+        post = self.getPosterior()
+        if post.get("compiled") is None:
+            post["compiled"] = CompiledSnippet(
+                self.name,
+                self.filter,
+                post["lengthscale"].numpy(),
+                post["outputscale"].item(),
+                post["noise"].item(),
+                post["constant"].item(),
+                post["jitter"],
+                post["X"].numpy(),
+                post["alpha"].numpy(),
+                post["varianceCache"].numpy(),
+                dtype=post["alpha"].numpy().dtype,
+            )
+
+        return post["compiled"]
+
+    # sweep points for each dim in dims, all in one (len(dims) * n, params) tensor.
+    # Row k * n + j is x with dims[k] set to the j-th value in [rmin, rmax]
+    def sweepPoints(self, x, dims, rmin=0, rmax=1, n=10):
+        XRange = torch.linspace(rmin, rmax, n, dtype=self.inferenceDtype())
+        XTest = torch.tensor(x, dtype=self.inferenceDtype()).repeat(len(dims) * n, 1)
+
+        rows = torch.arange(0, len(dims) * n)
+        cols = torch.tensor(dims, dtype=torch.long).repeat_interleave(n)
+        XTest[rows, cols] = XRange.repeat(len(dims))
+
+        return XTest
+
+    # predicts 1D sweeps of x over each dim in dims. Returns (len(dims), n) mean and
+    # cov tensors. With the ARD RBF kernel, moving only dim d scales the cross-covariance
+    # with training point i by a 1D factor:
+    #   k(x, xi) = k(x0, xi) * exp(-((v - xi_d)^2 - (x0_d - xi_d)^2) / (2 l_d^2))
+    # so every sweep comes from one shared k(x0, X) vector plus cheap per-dim terms
+    def predictSweeps(self, x, dims, rmin=0, rmax=1, n=10):
+        if self.trainedMode != "RBF":
+            res = self.predict(self.sweepPoints(x, dims, rmin, rmax, n))
+            return res["mean"].view(len(dims), n), res["cov"].view(len(dims), n)
+
+        post = self.getPosterior()
+        X = post["X"]
+        lengthscale = post["lengthscale"]
+
+        # shared term, the cross-covariance of x0 with every training point
+        dtype = X.dtype
+        x0 = torch.tensor(x, dtype=dtype)[self.filter]
+        k0 = post["outputscale"] * torch.exp(
+            -0.5 * ((x0 - X) / lengthscale).pow(2).sum(dim=1)
+        )
+
+        # dims outside of the filter don't change the prediction (factor of 1)
+        pos = [self.filter.index(d) if d in self.filter else -1 for d in dims]
+        active = torch.tensor([p >= 0 for p in pos])
+        pos = torch.tensor([max(p, 0) for p in pos], dtype=torch.long)
+
+        XRange = torch.linspace(rmin, rmax, n, dtype=dtype)
+        Xd = X[:, pos] / lengthscale[pos]
+        before = (x0[pos] / lengthscale[pos] - Xd).pow(2)
+        after = (XRange.view(1, -1, 1) / lengthscale[pos] - Xd.unsqueeze(1)).pow(2)
+        factor = torch.exp(-0.5 * (after - before.unsqueeze(1)))
+        factor[:, :, ~active] = 1
+
+        # (dims, n, training points) cross-covariance for all sweep points
+        Kxs = (k0.view(-1, 1, 1) * factor).permute(2, 1, 0).reshape(len(dims) * n, -1)
+
+        mean = post["constant"] + Kxs @ post["alpha"]
+        V = Kxs @ post["varianceCache"]
+        cov = post["outputscale"] + post["jitter"] - V.pow(2).sum(dim=1) + post["noise"]
+
+        return mean.view(len(dims), n), cov.view(len(dims), n)
+
     def predict1D(self, x, dim, rmin=0, rmax=1, n=10):
-        XRange = torch.linspace(rmin, rmax, n)
-        XTest = []
-        for i in XRange:
-            xt = x.copy()
-            xt[dim] = i
-            XTest.append(xt)
-
-        res = self.predict(XTest)
+        mean, cov = self.predictSweeps(x, [dim], rmin, rmax, n)
         return {
-            "mean": res["mean"].numpy().tolist(),
-            "cov": res["cov"].numpy().tolist(),
+            "mean": mean[0].numpy().tolist(),
+            "cov": cov[0].numpy().tolist(),
         }
 
+    # sweeps every filtered dim at once
     def predictAll1D(self, x, rmin=0, rmax=1, n=10):
-        dims = {}
-        for i in self.filter:
-            res = self.predict1D(x, i, rmin, rmax, n)
-            dims[i] = res
-        return dims
+        dims = list(self.filter)
+        if len(dims) == 0:
+            return {}
+
+        mean, cov = self.predictSweeps(x, dims, rmin, rmax, n)
+        mean = mean.numpy().tolist()
+        cov = cov.numpy().tolist()
+
+        return {dims[k]: {"mean": mean[k], "cov": cov[k]} for k in range(0, len(dims))}
+
+    # sensitivity of the posterior mean to each filtered param at x (one point, or a list
+    # or (n, params) tensor of points). Returns the params (the filter), the mean and its
+    # (n, len(filter)) gradient from one autograd pass. With hessian, also the diagonal
+    # of the hessian. That is analytic for the exact RBF model, with w_i = alpha_i k(x, X_i):
+    #   d2m / dx_d^2 = sum_i w_i ((x_d - X_id)^2 / l_d^4 - 1 / l_d^2)
+    # other modes take one more backward pass per param
+    def sensitivity(self, x, hessian=False):
+        X = torch.as_tensor(x, dtype=self.inferenceDtype())
+        if X.dim() == 1:
+            X = X.unsqueeze(0)
+
+        analytic = self.trainedMode == "RBF"
+        with torch.enable_grad():
+            Xf = X[:, self.filter].detach().requires_grad_(True)
+            mean = self.predictFiltered(Xf)["mean"]
+            grad = torch.autograd.grad(
+                mean.sum(), Xf, create_graph=hessian and not analytic
+            )[0]
+
+            res = {
+                "params": list(self.filter),
+                "mean": mean.detach(),
+                "gradient": grad.detach(),
+            }
+
+            if hessian and not analytic:
+                res["hessian"] = torch.stack(
+                    [
+                        torch.autograd.grad(grad[:, d].sum(), Xf, retain_graph=True)[0][
+                            :, d
+                        ]
+                        for d in range(0, Xf.shape[1])
+                    ],
+                    dim=1,
+                ).detach()
+
+        if hessian and analytic:
+            post = self.getPosterior()
+            with torch.no_grad():
+                Xp = Xf.detach().to(post["Z"].dtype)
+                lengthscale2 = post["lengthscale"].pow(2)
+                Kxs = post["outputscale"] * torch.exp(
+                    -0.5 * sqDist(Xp / post["lengthscale"], post["Z"])
+                )
+                w = Kxs * post["alpha"]
+                wSum = w.sum(dim=1, keepdim=True)
+
+                # sum_i w_i (x_d - X_id)^2, expanded so no (n, N, dims) tensor is built
+                sqDiff = (
+                    Xp.pow(2) * wSum - 2 * Xp * (w @ post["X"]) + w @ post["X"].pow(2)
+                )
+                res["hessian"] = sqDiff / lengthscale2.pow(2) - wSum / lengthscale2
+
+        return res
 
     def x0(self):
-        if self.data:
+        if self.dataCount > 0:
             # NOTE: CHANGE LATER THIS ASSUMES FIRST EXAMPLE IS POSITIVE
-            return self.data[0].data
+            return self.dataX[0].tolist()
         else:
             return 0
 
     # returns the positive example from the example set
     def posExamples(self):
-        pos = []
-        for i in self.data:
-            if i.score > 0.5:
-                pos.append(i.data)
-
-        return pos
+        if self.dataCount == 0:
+            return []
+
+        X = self.dataX[0 : self.dataCount]
+        y = self.dataY[0 : self.dataCount]
+        return X[y > 0.5].tolist()
+
+    # linked params as parallel (param, linked param) index tensors, rebuilt only
+    # when paramInfo is replaced
+    def getLinkIndex(self):
+        if self.linkIndex is None or self.linkIndex["paramInfo"] is not self.paramInfo:
+            src = []
+            dst = []
+            if self.paramInfo:
+                for id in range(0, len(self.paramInfo)):
+                    for linkID in self.paramInfo[id]["links"]:
+                        src.append(id)
+                        dst.append(linkID)
+
+            self.linkIndex = {
+                "paramInfo": self.paramInfo,
+                "src": torch.tensor(src, dtype=torch.long),
+                "dst": torch.tensor(dst, dtype=torch.long),
+            }
+
+        return self.linkIndex
 
     def getDefaultFilter(self):
+        if self.dataCount == 0:
+            return []
+
+        # cached until the data or param info changes
+        key = (self.dataVersion, id(self.paramInfo))
+        if self.defaultFilterCache is not None and self.defaultFilterCache[0] == key:
+            return list(self.defaultFilterCache[1])
+
         # assumption: all data is the same vector length
-        filter = set()
-
-        # for each parameter
-        for i in range(0, len(self.data[0].data)):
-            # extract vector of params
-            p = list(map(lambda x: x.data[i], self.data))
-
-            # map again, test == to first val
-            p0 = p[0]
-            isEq = list(map(lambda x: math.isclose(x, p0, rel_tol=1e-3), p))
-
-            # reduce with &
-            allEq = reduce(lambda x, y: x and y, isEq)
-
-            if not allEq:
-                filter.add(i)
-
-        # Check for linked params
-        if self.paramInfo:
-            for id in list(filter):
-                # if there's something in the linked field
-                links = self.paramInfo[id]["links"]
-                if len(links) > 0:
-                    # append them to the filter without duplication
-                    for linkID in links:
-                        filter.add(linkID)
-
-        # convert to list on return
+        # a param is in the filter if any example differs from the first one
+        # (same test as math.isclose(x, p0, rel_tol=1e-3), over all columns at once)
+        X = self.dataX[0 : self.dataCount]
+        x0 = X[0]
+        tol = 1e-3 * torch.max(X.abs(), x0.abs())
+        changed = ((X - x0).abs() > tol).any(dim=0)
+
+        # Check for linked params, links of changed params are added to the filter
+        links = self.getLinkIndex()
+        if len(links["src"]) > 0:
+            changed[links["dst"][changed[links["src"]]]] = True
+
+        filter = changed.nonzero().view(-1).tolist()
+        self.defaultFilterCache = (key, filter)
+
         return list(filter)
 
     def setDefaultFilter(self):
@@ -322,16 +1721,34 @@ class Snippet:
     # returns a set of parameters that meet an impact threshold
     # Impact here is going to be defined as parameters that cause
     # large changes in the score value, relative to the variation across
-    # the 1D parameter sweeps at the given point
-    def identifyHighImpactParams(self, x0, magnitudeThreshold=0.75):
-        # coarse sweep, n = 10
-        paramScores = self.predictAll1D(x0, n=10)
+    # the 1D parameter sweeps at the given point.
+    # method "relevance" skips the sweeps and uses the ARD relevance (1 / lengthscale)
+    # of the trained kernel instead, which doesn't depend on x0.
+    # method "gradient" uses the magnitude of the mean's gradient (see sensitivity). x0 can
+    # also be a list of points, the magnitudes are then averaged over them
+    def identifyHighImpactParams(self, x0, magnitudeThreshold=0.75, method="sweep"):
         paramMag = {}
         maxMag = 0
 
+        if method == "relevance":
+            relevance = (1 / self.getLengthscale()).tolist()
+            for i in range(0, len(self.filter)):
+                paramMag[self.filter[i]] = relevance[i]
+        elif method == "gradient":
+            grad = self.sensitivity(x0)["gradient"].abs().mean(dim=0).tolist()
+            for i in range(0, len(self.filter)):
+                paramMag[self.filter[i]] = grad[i]
+        else:
+            # coarse sweep, n = 10
+            paramScores = self.predictAll1D(x0, n=10)
+
+            for id in paramScores:
+                paramMag[id] = max(paramScores[id]["mean"]) - min(
+                    paramScores[id]["mean"]
+                )
+
         # determine max magnitude changes
-        for id in paramScores:
-            paramMag[id] = max(paramScores[id]["mean"]) - min(paramScores[id]["mean"])
+        for id in paramMag:
             if paramMag[id] > maxMag:
                 maxMag = paramMag[id]
 
@@ -345,16 +1762,45 @@ class Snippet:
         return params
 
     # similar to high impact params, best params are those that can achieve close to maximal
-    # values along their 1D sweep range relative to the given x0
-    def identifyBestParams(self, x0, bestThreshold=0.75):
-        # coarse sweep
-        paramScores = self.predictAll1D(x0, n=10)
+    # values along their 1D sweep range relative to the given x0.
+    # method "gradient" replaces the sweeps with the maximum over [0, 1] of the second
+    # order expansion m + g t + h t^2 / 2 of each param's sweep (see sensitivity). x0 can
+    # also be a list of points, the maximums are then averaged over them
+    def identifyBestParams(self, x0, bestThreshold=0.75, method="sweep"):
         paramMax = {}
         scoreMax = 0
 
+        if method == "gradient":
+            sens = self.sensitivity(x0, hessian=True)
+            X = torch.as_tensor(x0, dtype=sens["gradient"].dtype)
+            if X.dim() == 1:
+                X = X.unsqueeze(0)
+            X = X[:, self.filter]
+            m = sens["mean"].unsqueeze(1)
+            g = sens["gradient"]
+            h = sens["hessian"]
+
+            def expansion(t):
+                return m + g * t + 0.5 * h * t * t
+
+            # the stationary point is a maximum if h < 0, otherwise only the ends count
+            lo = -X
+            hi = 1 - X
+            t = torch.where(h < 0, -g / h.clamp_max(-1e-12), lo)
+            t = torch.min(torch.max(t, lo), hi)
+            best = torch.max(torch.max(expansion(lo), expansion(hi)), expansion(t))
+            best = best.mean(dim=0).tolist()
+            for i in range(0, len(self.filter)):
+                paramMax[self.filter[i]] = best[i]
+        else:
+            # coarse sweep
+            paramScores = self.predictAll1D(x0, n=10)
+
+            for id in paramScores:
+                paramMax[id] = max(paramScores[id]["mean"])
+
         # determine max magnitude changes
-        for id in paramScores:
-            paramMax[id] = max(paramScores[id]["mean"])
+        for id in paramMax:
             if paramMax[id] > scoreMax:
                 scoreMax = paramMax[id]
 
@@ -366,3 +1812,102 @@ class Snippet:
                 params.append(int(id))
 
         return params
+
+
+# trains a group of exact RBF snippets (same filter size, learning rate and training
+# precision, adam) as one batch model with a single optimizer loop. Every snippet keeps
+# its own step count and convergence check, and its hyperparameters are frozen when it
+# stops, so the result matches training them one at a time. Returns each retData.
+def trainSnippetBatch(snippets, warmStart=None):
+    prepared = [s.prepareTrain(warmStart=warmStart) for s in snippets]
+    dims = len(snippets[0].filter)
+    dtype = snippets[0].trainDtype()
+    maxN = max(len(y) for X, y, prevState in prepared)
+
+    X = torch.zeros(len(snippets), maxN, dims, dtype=dtype)
+    y = torch.zeros(len(snippets), maxN, dtype=dtype)
+    mask = torch.zeros(len(snippets), maxN, dtype=dtype)
+    steps = []
+    for b, (sX, sy, prevState) in enumerate(prepared):
+        X[b, 0 : len(sy)] = sX
+        y[b, 0 : len(sy)] = sy
+        mask[b, 0 : len(sy)] = 1
+        s = snippets[b]
+        steps.append(s.optSteps if prevState is None else s.warmStartStepCount())
+        s.losses = []
+
+    # start from each snippet's (default or warm start) hyperparameters
+    model = BatchGPModel(len(snippets), dims).to(dtype)
+    model.jitter = torch.stack([s.gpr.jitter for s in snippets]).view(-1, 1)
+    params = dict(model.named_parameters())
+    with torch.no_grad():
+        for b, s in enumerate(snippets):
+            for name, param in s.gpr.named_parameters():
+                params[name][b] = param.view_as(params[name][b])
+
+    def writeBack(b):
+        with torch.no_grad():
+            for name, param in snippets[b].gpr.named_parameters():
+                param.copy_(params[name][b].view_as(param))
+
+    optimizer = torch.optim.Adam(model.parameters(), lr=snippets[0].learningRate)
+    active = list(range(len(snippets)))
+    stopReasons = {}
+    stalled = [0] * len(snippets)
+
+    for i in range(max(steps)):
+        try:
+            optimizer.zero_grad()
+            losses = model.loss(X, y, mask)
+            losses.sum().backward()
+            optimizer.step()
+        except Exception:
+            # the snippets still training go through Snippet.train, which can recover
+            # from a failed step by raising the jitter
+            logger.warning(
+                "Batch training failed: {0}, training {1} snippets individually".format(
+                    sys.exc_info()[0], len(active)
+                )
+            )
+            for b in active:
+                stopReasons[b] = "fallback"
+            break
+
+        for b in list(active):
+            s = snippets[b]
+            s.losses.append(losses[b].item())
+
+            if len(s.losses) > s.lossWindow:
+                prev = s.losses[-1 - s.lossWindow]
+                change = abs(prev - s.losses[-1]) / max(abs(prev), 1e-12)
+                stalled[b] = stalled[b] + 1 if change < s.lossTolerance else 0
+
+                if stalled[b] >= s.lossPatience:
+                    stopReasons[b] = "converged"
+
+            if b not in stopReasons and len(s.losses) >= steps[b]:
+                stopReasons[b] = "maxSteps"
+
+            # stopped snippets keep the parameters from this step, the batch model
+            # still updates them but they aren't written back again
+            if b in stopReasons:
+                active.remove(b)
+                writeBack(b)
+
+        if len(active) == 0:
+            break
+
+    results = []
+    for b, s in enumerate(snippets):
+        if stopReasons[b] == "fallback":
+            results.append(s.train(warmStart=warmStart))
+            continue
+
+        if b in active:
+            writeBack(b)
+
+        results.append(
+            s.pruneParams(s.finishTrain(prepared[b][2] is not None, stopReasons[b]))
+        )
+
+    return results
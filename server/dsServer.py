@@ -142,6 +142,15 @@ def removeData(args):
         return None, False
 
 
+@sio.on("snippet update posterior")
+def updateSnippetPosterior(args):
+    s = snippetServer.getSnippet(args["name"])
+    if s:
+        return None, s.updatePosterior()
+    else:
+        return None, False
+
+
 @sio.on("snippet train")
 def trainSnippet(args):
     s = snippetServer.getSnippet(args["name"])
@@ -150,12 +159,21 @@ def trainSnippet(args):
         if "customFilter" in args:
             customFilter = args["customFilter"]
 
-        ret = s.train(customFilter=customFilter)
+        ret = s.train(customFilter=customFilter, warmStart=args.get("warmStart"))
         return None, ret
     else:
         return None, False
 
 
+# trains several snippets together, returns each snippet's train result by name
+@sio.on("snippets train")
+def trainSnippets(args):
+    ret = snippetServer.trainSnippets(
+        args.get("names"), warmStart=args.get("warmStart")
+    )
+    return None, ret
+
+
 @sio.on("snippet plotLastLoss")
 def snippetPlotLastLoss(args):
     s = snippetServer.getSnippet(args["name"])
@@ -220,26 +238,36 @@ def snippetPredictOne(args):
         return None, False
 
 
+@sio.on("snippet posterior stats")
+def snippetPosteriorStats(args):
+    s = snippetServer.getSnippet(args["name"])
+    if s:
+        return None, s.posteriorStats()
+    else:
+        return None, False
+
+
 @sio.on("snippet sample")
 def snippetSample(args):
     global currentSampler
     if currentSampler is None or (not currentSampler.is_alive()):
         s = snippetServer.getSnippet(args["name"])
         if s:
-            currentSampler = samplers.Rejection(
+            # rejection by default, "metropolis" runs the (multi-chain) Metropolis sampler,
+            # "thompson" the posterior draw sampler
+            sampler = samplers.Rejection
+            if args.get("sampler") == "metropolis":
+                sampler = samplers.Metropolis
+            elif args.get("sampler") == "thompson":
+                sampler = samplers.Thompson
+
+            currentSampler = sampler(
                 s,
                 name=args["name"],
                 cb=lambda data: sampleSingleResult(data, args["name"]),
                 final=sampleFinal,
                 **args["data"]
             )
-            # currentSampler = samplers.Metropolis(
-            #     s,
-            #     name=args["name"],
-            #     cb=lambda data: sampleSingleResult(data, args["name"]),
-            #     final=sampleFinal,
-            #     **args["data"],
-            # )
             currentSampler.start()
             return None, True
         else:
@@ -333,6 +361,19 @@ def snippet1DPredictAll(args):
         return None, False
 
 
+@sio.on("snippet sensitivity")
+def snippetSensitivity(args):
+    s = snippetServer.getSnippet(args["name"])
+    if s:
+        res = s.sensitivity(args["x"], args.get("hessian", False))
+        for key in ["mean", "gradient", "hessian"]:
+            if key in res:
+                res[key] = res[key].numpy().tolist()
+        return None, res
+    else:
+        return None, False
+
+
 @sio.on("snippet identifyHighImpact")
 def snippetIdentifyHighImpact(args):
     s = snippetServer.getSnippet(args["name"])
@@ -386,37 +427,44 @@ def jitterSample(args):
     scoreFunc = None
     if "snippet" in args:
         snippet = snippetServer.getSnippet(args["snippet"])
+
+        # opt in to scoring with the numpy-only compiled snippet
+        if args.get("compiled", False):
+            snippet = snippet.compile()
+
         scoreFunc = lambda x: snippet.predictOne(x)["mean"]
 
     samples = jitter(args["x0"], args["delta"], scoreFunc=scoreFunc, **args["opt"])
     return None, samples
 
 
-# command line args
-# manual parse for optional args
-host = "localhost"
-port = 5234
+# sampler worker processes re-import this module, only connect from the main process
+if __name__ == "__main__":
+    # command line args
+    # manual parse for optional args
+    host = "localhost"
+    port = 5234
 
-# search args
-args = sys.argv[1:]
+    # search args
+    args = sys.argv[1:]
 
-# check host
-try:
-    hLoc = args.index("-h")
-    host = args[hLoc + 1]
-except:
-    print("Using default host 'localhost'")
+    # check host
+    try:
+        hLoc = args.index("-h")
+        host = args[hLoc + 1]
+    except:
+        print("Using default host 'localhost'")
 
-# check port
-try:
-    pLoc = args.index("-p")
-    port = int(args[pLoc + 1])
-except:
-    print("Using default port '5234'")
+    # check port
+    try:
+        pLoc = args.index("-p")
+        port = int(args[pLoc + 1])
+    except:
+        print("Using default port '5234'")
 
-url = "http://" + host + ":" + str(port)
-print("Connecting to Server at {0}".format(url))
+    url = "http://" + host + ":" + str(port)
+    print("Connecting to Server at {0}".format(url))
 
-sio.connect(url)
+    sio.connect(url)
 
-logger.info("Design Snippets server launched")
+    logger.info("Design Snippets server launched")